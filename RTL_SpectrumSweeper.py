@@ -33,23 +33,36 @@
 import os
 import sys
 import time
-import subprocess
+import json
+import colorsys
+import collections
 import datetime
+import threading
+import queue
+import asyncio
+import shlex
+import multiprocessing
 import platform
+import shutil
+import gzip
+import lzma
+import zlib
+import struct
+import base64
+import hashlib
 
 import numpy as np
-import tkinter as tk
-import PIL.Image as Image
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
-import matplotlib.gridspec as gridspec
-import matplotlib.animation as animation
+# matplotlib and PIL are imported by load_plotting / load_image, only once
+# they are needed (see below)
+mpl = None
+plt = None
+gridspec = None
+Image = None
 
 
 
-version = '1.1.2'
+version = '2.1.0'
 
 ###############################################################################
 #                                                                             #
@@ -84,6 +97,77 @@ version = '1.1.2'
     second number is the number of rows allocated for the spectrum. Remaining
     rows are for the waterfall. 
     
+    Version 2.1.0: (20261017) The csv file is now read incrementally. Only
+    the lines appended since the last poll are parsed (straight into numpy
+    arrays), and a partly written last line is held until it is complete. 
+    The spectrum trace is kept as a running average, so flatten.py is no 
+    longer needed. The waterfall is colorized in-process with a palette 
+    lookup table, so heatmap.py is no longer needed either, and the png is
+    only written when the sweep finishes. The waterfall is held in one 
+    preallocated buffer that is written in place (and scrolls when autostop
+    is disabled), and the image is updated with set_data. The spectrum 
+    trace and waterfall image are created once and redrawn with blitting.
+    The layout is only recomputed on a window resize, and the y limits only
+    when the trace leaves them. Added a --noblit option to fall back to 
+    full redraws. The time.sleep calls were removed from the gui thread and
+    startup. A watcher thread flags new data, and the gui timer interval 
+    follows the measured sweep period (the -i value was never used). 
+    Added a --pipe mode that reads the rows from rtl_power's stdout as they
+    are produced, with the csv file written by a background thread (or not
+    at all with --nocsv). Added --rtl_power to run a different command, 
+    such as fake_rtl_power.py, which produces synthetic rows for testing. 
+    The spectrum is kept in numpy accumulators, and --traces can add max 
+    hold, min hold and exponential moving average (--ema) traces. Added a 
+    --headless mode (no tk, Agg backend) that writes the waterfall and plot
+    images to files, and --batch to run many headless captures in a 
+    process pool. Added --store to also write the sweeps to a compact, 
+    memory-mappable binary file with a timestamp index, and --convert to 
+    convert an existing csv file to it. Added --replay to re-render an 
+    existing csv or binary capture (parsed in parallel byte ranges) to a 
+    png, or to replay it into the gui at --speed N times real time. Added 
+    --devices to split the -f range across several dongles that sweep in 
+    parallel, with their sweeps stitched back into one. Hops are assembled
+    onto a uniform frequency grid with an index map learned from the first
+    sweep, and --overlap sets how overlapping hop samples are combined. 
+    The traces and the waterfall are decimated to the pixel width of the 
+    axes (min/max and peak envelopes), and re-planned on resize or zoom. 
+    The store keeps a max pyramid of the sweep history, and --browse opens
+    it in a window where each zoom or pan only reads the tiles in view. 
+    Added --detect N to find signals N dB above a per-bin noise floor as 
+    the sweeps arrive, and log their onset and offset to a jsonl file. 
+    Added --rotate to rotate the csv file by size or time for unattended 
+    captures, with the closed segments compressed (--compress) by a 
+    background thread. 
+    Startup is faster: matplotlib and PIL are only imported when they are
+    needed (after rtl_power has been started), tk is not used separately 
+    from the plot window, rtl_power's startup messages are read by a 
+    background thread, and the time to the first frame is reported. 
+    In pipe mode rtl_power now runs under a supervisor (asyncio) that 
+    drains its output, and restarts it after a crash or a stall (--restarts,
+    --stall), with its health shown at the top of the figure. 
+    New sweeps are read and assembled by a reader thread, and folded into 
+    the waterfall, spectrum, store and detector by a worker thread, so the
+    gui thread only draws the latest state and stays responsive on large 
+    sweeps. Added --serve to watch the capture in a web browser, with each
+    new batch of waterfall rows and the trace sent to every viewer as one 
+    small binary WebSocket message. The waterfall colors span the 5th to 
+    99.5th percentile of a decaying histogram of the dB values, instead of
+    the capture's min and max, so one strong burst no longer recolors the
+    whole history. The stored rows are only recolored (with one table 
+    lookup) when that range drifts by more than 2 dB. Added --resume, 
+    which checkpoints the waterfall, spectrum and color scale every minute,
+    and on restart loads the checkpoint and only parses the end of the csv
+    file written after it, then carries on appending to the same file. 
+    Hovering over the waterfall shows the frequency, time and power under 
+    the mouse, and clicking a row shows that sweep in the spectrum axes. 
+    Added --plan to share one dongle between several bands, each with its
+    own rtl_power options, palette, dwell, waterfall, spectrum and files, 
+    with the revisit time and duty cycle of each band reported. Added --shm
+    to publish the sweeps in a shared memory ring buffer, which other 
+    programs can read as numpy arrays (see shm_consumer.py). rtl_power is
+    now always read through a pipe, so every capture is supervised and 
+    restarted after a crash or stall (--pipe is the default). 
+    
     
 
 ############################################################################"""
@@ -136,48 +220,6 @@ sys.argv = cmd_str.split()
 '''
 
 
-"""############################################################################
-
-    Confirm and if needed Download Required Files
-
-############################################################################"""
-
-heatmap_url = "https://github.com/davesmotleyprojects/rtl-sdr-misc/raw/master/heatmap/heatmap.py"
-heatmap_path = os.path.join(sys.path[0], "heatmap.py")
-flatten_url = "https://github.com/davesmotleyprojects/rtl-sdr-misc/raw/master/heatmap/flatten.py"
-flatten_path = os.path.join(sys.path[0], "flatten.py")
-
-urlretrieve = lambda a, b: None
-try:
-    import urllib.request
-    urlretrieve = urllib.request.urlretrieve
-except:
-    import urllib
-    urlretrieve = urllib.urlretrieve
-    
-if not os.path.isfile(heatmap_path):
-    print('\nUnable to locate heatmap.py file at {}' .format(heatmap_path))
-    try:
-        print('Attempting to download it from {}' .format(heatmap_url))
-        urlretrieve(heatmap_url, heatmap_path)
-        print('Download successful')
-    except Exception as e:
-        print('Exception occurred while attempting download.\n{}\n' .format(e))
-        print('Please download heatmap.py and place it in the current directory.')
-        sys.exit(1)
-        
-if not os.path.isfile(flatten_path):
-    print('\nUnable to locate flatten.py file at {}' .format(flatten_path))
-    try:
-        print('Attempting to download it from {}' .format(flatten_url))
-        urlretrieve(flatten_url, flatten_path)
-        print('Download successful')
-    except Exception as e:
-        print('Exception occurred while attempting download.\n{}\n' .format(e))
-        print('Please download flatten.py and place it in the current directory.')
-        sys.exit(1)
-
-
 """############################################################################
 
     Global Variables
@@ -190,9 +232,14 @@ class global_vars:
 
         self.filename = ""
         self.sweeptime = 0
+        self.start_time = time.time()   # for the time to the first frame
 
         self.opt_str = ""
         self.rtl_str = ""
+        self.rtl_cmd = "rtl_power"
+        self.nocsv = False      # do not write the csv file
+        self.devices = []       # split the -f range across these dongles
+        self.overlap = "trim"   # hop overlap policy, one of overlap_names
         self.hmp_str = ""
         
         self.stop = 1       # 0 = autostop disabled
@@ -209,11 +256,73 @@ class global_vars:
         self.done = False
         
         self.csv_path = ""
-        self.old_csv_size = 0
+        self.reader = None      # rtl_supervisor, or a replay reader
+        self.sink = None        # csv_sink for the csv file
+        self.assembler = None
+        self.sweep_count = 0
+
+        # read from tk in initialize_plot (not here, so that the module can
+        # be imported on a machine with no display) 
+        self.scrn_width_in = 0
+        self.scrn_height_in = 0
+        
+        self.headless = False       # no gui, write images to files instead
+        self.out_size = [1600, 900] # headless plot image size in pixels
+        self.size_set = False       # --size was given
+        self.save_every = 0         # headless: save images every N sweeps
+        self.last_save = 0
+        self.batch_file = ""        # run the captures listed in this file
+        self.procs = 0              # batch processes (0 = one per core)
+        self.batch_worker = False   # this capture is one line of a batch
+        self.failed = False         # main stopped on an exception
+        self.plan_file = ""         # scan the bands listed in this file
+        self.dwell_s = 60.0         # time per visit of a plan band
+        self.plan_band = False      # this capture is a band of a --plan
+        
+        self.store = None           # sweep_store, when --store is given
+        self.use_store = False
+        self.convert_file = ""      # convert this csv file and exit
+        self.replay_file = ""       # re-render this csv or .sweeps capture
+        self.replay_speed = 0.0     # 0 = render to png, N = replay at N x
+        self.browse_file = ""       # browse this capture's sweep history
+        self.detect_db = 0.0        # 0 = off, N = detect signals N dB up
+        self.detector = None        # activity_detector
+        self.rotate_bytes = 0       # rotate the csv file at this size,
+        self.rotate_s = 0           # or after this long (0 = never)
+        self.compress = "gzip"      # rotated segments, one of compress_names
+        self.restarts = 5           # rtl_power restarts in a row
+        self.stall_k = 3            # restart after this many silent -i
+        self.supervisors = []       # rtl_supervisor of each rtl_power
+        self.health = ""
+        self.health_text = None     # the health line on the figure
+        self.pipeline = None        # sweep_pipeline, once the plot exists
+        self.resume = False         # continue the capture from a checkpoint
+        self.checkpoint = None      # the loaded checkpoint arrays
+        self.last_checkpoint = time.time()
+        self.last_time = 0.0        # timestamp of the last processed sweep
+        self.store_after = None     # on resume, the last sweep in the store
+        self.state_lock = threading.RLock() # held to change or draw the state
+        self.drawn_seq = 0          # the last pipeline seq that was drawn
+        self.replan_pending = False
+        self.serve_host = "127.0.0.1"   # --serve, the live viewer server
+        self.serve_port = 0             # (0 = off)
+        self.server = None              # live_server
+        self.shm_name = ""          # --shm, publish sweeps in shared memory
+        self.shm = None             # sweep_shm
+        self.pyramid = None         # waterfall_pyramid of the store
+        self.browse_dirty = False
+        self.browse_count = 0
 
-        root = tk.Tk()
-        self.scrn_width_in = root.winfo_screenmmwidth() / 25.4
-        self.scrn_height_in = root.winfo_screenmmheight() / 25.4
+        self.palette_name = "default"
+        self.rgbxy = [255, 255, 0, 15, 140]     # custom palette (bright yellow)
+        self.palette = None
+        self.db_min = None          # the color range, from g.scale
+        self.db_max = None
+        self.scale = None           # color_scale of the waterfall
+        self.wf = None
+        self.wf_pad = 0
+        self.wf_image = None
+        self.pending_sweeps = []
 
         self.combined_image = None
         self.tmax = 0.0
@@ -232,10 +341,27 @@ class global_vars:
         self.rtl_proc = None
 
         self.anim = None 
-        self.anim_intvl = self.sweeptime * 1000
+        self.anim_intvl = 100   # ms, replaced by the sweep_watcher interval
+        self.watcher = None
+        self.blit = True
+        self.blit_bg = None
+        self.ylim_band = 0.5    # redo the y limits if the trace uses less
+                                # than this fraction of them
+        self.lines = {}         # spectrum trace name: Line2D
+        self.selected = None    # (timestamp, rank) of the clicked sweep
+        self.select_pending = False
+        self.sel_line = None    # the selected sweep in the spectrum axes
+        self.sel_marker = None  # and its row in the waterfall
+        self.sel_text = None
+        self.spec_dec = None    # bin_decimator for the spectrum axes
+        self.wf_dec = None      # bin_decimator for the waterfall axes
+        self.replanning = False
 
-        self.x_vals = []
-        self.y_vals = []
+        self.x_vals = []        # MHz of each bin, offset applied once
+        self.y_vals = []        # the average trace
+        self.spectrum = None    # spectrum_accumulator
+        self.traces = ["avg"]   # any of trace_names
+        self.ema_alpha = 0.1
         
         
 print("\nInitializing global variables... ", end='', flush=True)   
@@ -243,6 +369,42 @@ g = global_vars()
 print("done")
 
 
+"""############################################################################
+
+    function:   load_plotting / load_image 
+
+    Import matplotlib (with the given backend, e.g. 'Agg' when headless) 
+    and PIL the first time they are needed. Importing them takes a second
+    or more on a Raspberry Pi, so this is done after rtl_power has been 
+    started, while it is busy with the first sweep, and not at all by the 
+    modes that do not plot (--convert, and --batch in the parent process).
+
+############################################################################"""
+
+def load_plotting(backend=None):
+    
+    global mpl, plt, gridspec
+    
+    if (plt is None):
+        start = time.time()
+        import matplotlib as mpl
+        if (backend is not None):
+            mpl.use(backend)
+        import matplotlib.pyplot as plt
+        import matplotlib.gridspec as gridspec
+        print("Loaded matplotlib ({}) in {:0.2f} s" .format(mpl.get_backend(), 
+            time.time() - start))
+    load_image()
+
+
+def load_image():
+    
+    global Image
+    
+    if (Image is None):
+        import PIL.Image as Image
+
+
 """############################################################################
 
     function:   process_args 
@@ -258,7 +420,7 @@ def process_args():
         
     skip = 0
     g.opt_str = ""
-    g.rtl_str = "rtl_power -P"
+    g.rtl_str = " -P"
     g.hmp_str = ""
     
     
@@ -294,13 +456,18 @@ def process_args():
                 pass
             elif (arg == "--palette"):
                 g.hmp_str += str(" --palette " + sys.argv[i+1])
+                g.palette_name = sys.argv[i+1]
                 skip=1
+                if g.palette_name not in palette_names:
+                    print("--palette must be one of {}" .format(", ".join(palette_names)))
+                    sys.exit(2)
                 pass
             elif (arg == "--rgbxy"):
                 R,G,B,X,Y = (str(sys.argv[i+1])).split(":")
                 g.hmp_str += str(" --rgbxy " + R + " " + G + " " + B)
                 g.hmp_str += str(" " + X + " " + Y)
                 R,G,B,X,Y = (int(R), int(G), int(B), int(X), int(Y))
+                g.rgbxy = [R,G,B,X,Y]
                 g.trace_color = ("#{:02X}{:02X}{:02X}" .format(R,G,B))
                 print("Trace Color: {}" .format(g.trace_color))
                 skip=1
@@ -308,14 +475,207 @@ def process_args():
                     print("--rbgxy index start X must be < index stop Y")
                     sys.exit(2)
                 pass
+            elif (arg == "--traces"):
+                g.opt_str += str(" --traces " + sys.argv[i+1])
+                g.traces = (sys.argv[i+1]).split(",")
+                print("Set traces: {}" .format(g.traces))
+                skip=1
+                for name in g.traces:
+                    if name not in trace_names:
+                        print("--traces must be a list of {}" .format(",".join(trace_names)))
+                        sys.exit(2)
+                pass
+            elif (arg == "--ema"):
+                g.opt_str += str(" --ema " + sys.argv[i+1])
+                g.ema_alpha = float(sys.argv[i+1])
+                print("Set ema alpha: {}" .format(g.ema_alpha))
+                skip=1
+                if ((g.ema_alpha <= 0) or (g.ema_alpha > 1)):
+                    print("--ema alpha must be > 0 and <= 1")
+                    sys.exit(2)
+                pass
+            elif (arg == "--headless"):
+                g.opt_str += str(" --headless")
+                g.headless = True
+                print("Set headless: on")
+                pass
+            elif (arg == "--size"):
+                g.opt_str += str(" --size " + sys.argv[i+1])
+                g.out_size = [int(v) for v in (sys.argv[i+1]).split("x")]
+                g.size_set = True
+                print("Set image size: {}" .format(g.out_size))
+                skip=1
+                pass
+            elif (arg == "--save"):
+                g.opt_str += str(" --save " + sys.argv[i+1])
+                g.save_every = int(sys.argv[i+1])
+                print("Set save every: {} sweeps" .format(g.save_every))
+                skip=1
+                pass
+            elif (arg == "--batch"):
+                g.opt_str += str(" --batch " + sys.argv[i+1])
+                g.batch_file = sys.argv[i+1]
+                print("Set batch file: {}" .format(g.batch_file))
+                skip=1
+                pass
+            elif (arg == "--plan"):
+                g.opt_str += str(" --plan " + sys.argv[i+1])
+                g.plan_file = sys.argv[i+1]
+                print("Set scan plan file: {}" .format(g.plan_file))
+                skip=1
+                pass
+            elif (arg == "--dwell"):
+                g.opt_str += str(" --dwell " + sys.argv[i+1])
+                g.dwell_s = duration_parse(sys.argv[i+1])
+                print("Set plan band dwell: {} seconds" .format(g.dwell_s))
+                skip=1
+                # rtl_power's -e is in whole seconds, and -e 0 never ends
+                if (g.dwell_s < 1.0):
+                    print("--dwell must be at least 1s")
+                    sys.exit(2)
+                pass
+            elif (arg == "--procs"):
+                g.opt_str += str(" --procs " + sys.argv[i+1])
+                g.procs = int(sys.argv[i+1])
+                print("Set batch processes: {}" .format(g.procs))
+                skip=1
+                pass
+            elif (arg == "--store"):
+                g.opt_str += str(" --store")
+                g.use_store = True
+                print("Set binary sweep store: on")
+                pass
+            elif (arg == "--convert"):
+                g.opt_str += str(" --convert " + sys.argv[i+1])
+                g.convert_file = sys.argv[i+1]
+                print("Set convert file: {}" .format(g.convert_file))
+                skip=1
+                pass
+            elif (arg == "--replay"):
+                g.opt_str += str(" --replay " + sys.argv[i+1])
+                g.replay_file = sys.argv[i+1]
+                print("Set replay file: {}" .format(g.replay_file))
+                skip=1
+                pass
+            elif (arg == "--browse"):
+                g.opt_str += str(" --browse " + sys.argv[i+1])
+                g.browse_file = sys.argv[i+1]
+                print("Set browse file: {}" .format(g.browse_file))
+                skip=1
+                pass
+            elif (arg == "--speed"):
+                g.opt_str += str(" --speed " + sys.argv[i+1])
+                g.replay_speed = float(sys.argv[i+1])
+                print("Set replay speed: {}x" .format(g.replay_speed))
+                skip=1
+                pass
+            elif (arg == "--noblit"):
+                g.opt_str += str(" --noblit")
+                g.blit = False
+                print("Set blitting: off")
+                pass
+            elif (arg == "--pipe"):
+                # rtl_power is always read through a pipe now, so this is 
+                # only accepted for older command lines
+                print("Pipe mode is the default")
+                pass
+            elif (arg == "--nocsv"):
+                g.opt_str += str(" --nocsv")
+                g.nocsv = True
+                print("Set csv file: off")
+                pass
+            elif (arg == "--devices"):
+                g.opt_str += str(" --devices " + sys.argv[i+1])
+                g.devices = [int(d) for d in (sys.argv[i+1]).split(",")]
+                print("Set devices: {}" .format(g.devices))
+                skip=1
+                pass
+            elif (arg == "--overlap"):
+                g.opt_str += str(" --overlap " + sys.argv[i+1])
+                g.overlap = sys.argv[i+1]
+                print("Set hop overlap: {}" .format(g.overlap))
+                skip=1
+                if g.overlap not in overlap_names:
+                    print("--overlap must be one of {}" .format(", ".join(overlap_names)))
+                    sys.exit(2)
+                pass
+            elif (arg == "--detect"):
+                g.opt_str += str(" --detect " + sys.argv[i+1])
+                g.detect_db = float(sys.argv[i+1])
+                print("Set activity detection: {} dB above the noise floor" .format(g.detect_db))
+                skip=1
+                pass
+            elif (arg == "--rotate"):
+                g.opt_str += str(" --rotate " + sys.argv[i+1])
+                if (sys.argv[i+1].endswith("B")):
+                    g.rotate_bytes = int(freq_parse(sys.argv[i+1][:-1]))
+                    print("Set csv rotation: every {} bytes" .format(g.rotate_bytes))
+                else:
+                    g.rotate_s = duration_parse(sys.argv[i+1])
+                    print("Set csv rotation: every {} seconds" .format(g.rotate_s))
+                skip=1
+                pass
+            elif (arg == "--compress"):
+                g.opt_str += str(" --compress " + sys.argv[i+1])
+                g.compress = sys.argv[i+1]
+                print("Set segment compression: {}" .format(g.compress))
+                skip=1
+                if g.compress not in compress_names:
+                    print("--compress must be one of {}" .format(", ".join(compress_names)))
+                    sys.exit(2)
+                pass
+            elif (arg == "--restarts"):
+                g.opt_str += str(" --restarts " + sys.argv[i+1])
+                g.restarts = int(sys.argv[i+1])
+                print("Set rtl_power restarts: {}" .format(g.restarts))
+                skip=1
+                pass
+            elif (arg == "--stall"):
+                g.opt_str += str(" --stall " + sys.argv[i+1])
+                g.stall_k = float(sys.argv[i+1])
+                print("Set rtl_power stall: {} sweep intervals" .format(g.stall_k))
+                skip=1
+                pass
+            elif (arg == "--resume"):
+                g.opt_str += str(" --resume")
+                g.resume = True
+                print("Set resume from checkpoint: on")
+                pass
+            elif (arg == "--serve"):
+                g.opt_str += str(" --serve " + sys.argv[i+1])
+                if (":" in sys.argv[i+1]):
+                    g.serve_host, port = sys.argv[i+1].rsplit(":", 1)
+                else:
+                    port = sys.argv[i+1]
+                g.serve_port = int(port)
+                print("Set live viewer: {}:{}" .format(g.serve_host, g.serve_port))
+                skip=1
+                pass
+            elif (arg == "--shm"):
+                g.opt_str += str(" --shm " + sys.argv[i+1])
+                g.shm_name = sys.argv[i+1]
+                print("Set shared memory sweeps: {}" .format(g.shm_name))
+                skip=1
+                pass
+            elif (arg == "--rtl_power"):
+                g.opt_str += str(" --rtl_power '" + sys.argv[i+1] + "'")
+                g.rtl_cmd = sys.argv[i+1]
+                print("Set rtl_power command: {}" .format(g.rtl_cmd))
+                skip=1
+                pass
             elif (arg == "-P"):
                 #do nothing. This is always added by default
                 pass
             else:
                 if(arg.find('.csv') != -1):
-                    g.csv_path = os.path.join(sys.path[0], arg)
+                    # rtl_power writes the file relative to the current 
+                    # working directory, so the reader must use the same path
+                    g.csv_path = os.path.abspath(arg)
                     g.filename = arg.strip('.csv')
                     print("Filename is {}.csv" .format(g.filename))
+                    # a '-' filename makes rtl_power write to stdout, 
+                    # and the csv file is written here
+                    arg = "-"
                 if(arg == "-i"):
                     g.sweeptime = duration_parse(sys.argv[i+1])
                     print("Sweep time is {} seconds" .format(g.sweeptime))
@@ -323,11 +683,11 @@ def process_args():
                     skip=True
                 g.rtl_str += str(" " + arg)
                 
+    g.rtl_str = g.rtl_cmd + g.rtl_str
+    
     print("\n")
     print("options = '{} {}'" .format(g.opt_str, g.hmp_str))
     print("{}" .format(g.rtl_str))
-        
-    time.sleep(3)
 
 
 """############################################################################
@@ -351,416 +711,4162 @@ def duration_parse(s):
     return float(s) * suffix
 
 
+def freq_parse(s):
+    suffix = 1
+    if s.endswith('k'):
+        suffix = 1e3
+    if s.endswith('M'):
+        suffix = 1e6
+    if s.endswith('G'):
+        suffix = 1e9
+    if suffix != 1:
+        s = s[:-1]
+    return float(s) * suffix
+
+
 """############################################################################
 
-    function:   start_rtl_power_process 
+    function:   parse_csv_line / format_csv_line 
+
+    Parses one line of rtl_power csv output into a hop tuple of the form
+    (timestamp, hz_low, hz_high, hz_step, samples, db_values), where 
+    db_values is a float32 numpy array. Returns None for lines that are
+    not valid rtl_power data (e.g. a line that was only partly written). 
+    format_csv_line makes the line for a hop tuple. 
 
 ############################################################################"""
 
-def start_rtl_power_process():
+def parse_csv_line(line):
+    
+    # rtl_power lines look like this:
+    # 2019-01-06, 17:24:01, 132000000, 132200000, 97.66, 4096, -42.1, ...
+    fields = line.split(",", 6)
+    if (len(fields) < 7):
+        return None
     
-    print("\nStarting rtl_power subprocess\n")
-        
     try:
-        
-        '''#####################################################################
-        IMPORTANT: There is a problem with rtl_power that will occassionally 
-        (or frequently, depending on settings) put "nan" in the csv file. 
-        This causes the heatmap.py to fail. 
-        Always using the '-P' option fixes this problem. 
-        #####################################################################'''
-         
-        print(g.rtl_str)
-        cmd = g.rtl_str.split()
-        print(cmd)
-        
-        g.fig_title = ("RTL_SpectrumSweeper using: '{} {}' for '{}' started {}" 
-            .format(g.opt_str, g.hmp_str, g.rtl_str, datetime.datetime.now()))
+        timestamp = parse_timestamp(fields[0].strip(), fields[1].strip())
+        hz_low = float(fields[2])
+        hz_high = float(fields[3])
+        hz_step = float(fields[4])
+        samples = int(fields[5])
+    except ValueError:
+        return None
+    
+    db_values = np.fromstring(fields[6], dtype=np.float32, sep=",")
+    if (len(db_values) == 0):
+        return None
+    
+    return (timestamp, hz_low, hz_high, hz_step, samples, db_values)
 
-        g.rtl_proc = subprocess.Popen(cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT, 
-            universal_newlines=True)
 
-        while(True):
-            rspn = (str(g.rtl_proc.stdout.readline())).rstrip()
-            if (rspn == "[R82XX] PLL not locked!"):
-                print(rspn)
-                break
-            elif (rspn == "b''"):
-                print(rspn)
-                break
-            else:
-                print(rspn)
+def format_csv_line(hop):
+    
+    # the reverse of parse_csv_line, in rtl_power's own format
+    stamp = datetime.datetime.fromtimestamp(hop[0]).strftime("%Y-%m-%d, %H:%M:%S")
+    return ("{}, {:.0f}, {:.0f}, {:.2f}, {:d}, {}\n" .format(stamp, hop[1], hop[2], 
+        hop[3], hop[4], ", ".join(np.char.mod("%.2f", hop[5]))))
 
-        print("done")
-        time.sleep(3)
+
+# every hop of a sweep carries the same date and time strings, so the last 
+# conversion is cached to avoid calling strptime once per hop. 
+_last_timestamp = ["", "", 0.0]
+
+def parse_timestamp(date_str, time_str):
     
-    except Exception as e:
-        
-        print("\nException occurred in start_rtl_power_process")
-        print(e)
-        
-        
+    if ((date_str != _last_timestamp[0]) or (time_str != _last_timestamp[1])):
+        dt = datetime.datetime.strptime(date_str + " " + time_str, "%Y-%m-%d %H:%M:%S")
+        _last_timestamp[0] = date_str
+        _last_timestamp[1] = time_str
+        _last_timestamp[2] = time.mktime(dt.timetuple())
+    return _last_timestamp[2]
+
+
 """############################################################################
 
-    function:   wait_for_initial_data 
+    class:      csv_tail_reader 
+
+    Reads only the lines that have been appended to the rtl_power csv file
+    since the previous call. The byte offset of the last complete line is
+    remembered, and a partly written last line is held back until the rest
+    of it arrives. This keeps the cost of each poll proportional to the new
+    data, rather than to the size of the whole capture. 
 
 ############################################################################"""
 
-def wait_for_initial_data():
-    
-    print("\nWaiting for initial data ready")
+class csv_tail_reader:
     
-    try:
+    def __init__(self, path, offset=0):
         
-        while(True):
-            time.sleep(1)
-            update_csv_data()
-            #update_waterfall()
-            update_spectrum()
-            if (len(g.y_vals) > 0):
-                g.ready = True
-                print("Ready!")
-                break
+        self.path = path
+        self.offset = offset        # file position of the next unread byte
+        self.partial = b""          # incomplete last line from the last read
         
-    except Exception as e:
+    def read_lines(self, max_bytes=0):
         
-        print("\nException occurred in wait_for_initial_data")
-        print(e)
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return []
+        
+        # the file was truncated or replaced (e.g. rtl_power was restarted 
+        # with the same filename). Start over from the beginning. 
+        if (size < self.offset):
+            print("csv file shrank, restarting from the beginning")
+            self.offset = 0
+            self.partial = b""
+        
+        if (size == self.offset):
+            return []
+        
+        count = size - self.offset
+        if ((max_bytes > 0) and (count > max_bytes)):
+            count = max_bytes
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(count)
+        self.offset += len(data)
         
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        return [line.decode("ascii", "replace") for line in lines]
+        
+    def at_end(self):
+        
+        try:
+            return (self.offset >= os.path.getsize(self.path))
+        except OSError:
+            return True
+        
+    def read_hops(self, max_bytes=0):
+        
+        hops = []
+        for line in self.read_lines(max_bytes):
+            hop = parse_csv_line(line)
+            if (hop is not None):
+                hops.append(hop)
+        return hops
+
 
 """############################################################################
 
-    function:   Initialize_plot 
+    class:      sweep_assembler 
+
+    rtl_power writes each sweep as several csv lines (one per hop) that all
+    share the same timestamp. This collects hops until the sweep is complete
+    and then joins them into a single row of dB values ordered by frequency.
+    A sweep is complete when a hop with a new timestamp arrives, when the 
+    hop frequency wraps back to the start (two short sweeps can share the 
+    same one-second timestamp), or as soon as it has the number of hops 
+    that the first complete sweep had. 
+    
+    The hop layout is learned from the first complete sweep and turned into
+    an index map from the hop samples to the bins of a uniform frequency 
+    grid. Where hops overlap, the 'trim' policy keeps the sample that is 
+    farthest from the edge of its hop (hop edges are the least accurate), 
+    and the 'average' policy averages them. Grid bins that no hop covers 
+    are nan. After that, each sweep is assembled with a single numpy 
+    gather/scatter (or bincount), with no per-bin Python work. 
 
 ############################################################################"""
 
-def initialize_plot():
-    
-    print("\nInitializing plot... ", end='', flush=True)
+overlap_names = ["trim", "average"]
+
+class sweep_assembler:
     
-    try:
+    def __init__(self, overlap="trim"):
         
-        # use tk to get the screen size, and set the plot window to be just 
-        # under the screen size. Note: The reading and setting of display 
-        # sizes on Win10 has not been straightforward. This seems to be 
-        # partly due to dpi scaling on my PC, but other values e.g. from 
-        # get_window_extent don't seem to be correct at all. This needs 
-        # further investigation. The use of "figure" in rcParams and in
-        # GridSpec is not compatible with Linux. 
-           
-        root = tk.Tk()
-        g.scrn_width_in = root.winfo_screenmmwidth() / 25.4
-        g.scrn_height_in = root.winfo_screenmmheight() / 25.4
-        
-        if (platform.system() == "Windows"):
-            plt.rcParams["figure.figsize"] = [g.scrn_width_in, g.scrn_height_in*0.9]
-            g.fig = plt.figure(g.fig_title)
-            gs = gridspec.GridSpec(g.rows[0], 1, figure=g.fig)
+        self.overlap = overlap
+        self.pending_time = None
+        self.pending = []           # hops of the sweep being collected
+        self.hops = 0               # hops per sweep, learned from sweep 1
+        self.freqs = None           # Hz of each bin, learned from sweep 1
+        self.layout = None          # (hz_low, samples) of each hop
+        self.src = None             # trim: sample index for each dst bin
+        self.dst = None
+        self.idx = None             # average: bin index of each sample
+        self.counts = None          # average: samples in each bin
+        self.samples = 0            # samples per sweep, across all hops
+        
+    def set_layout(self, freqs):
+        
+        # for sources that deliver whole sweeps as a single hop
+        self.freqs = np.asarray(freqs)
+        self.hops = 1
+        self.layout = None
+        self.overlap = "trim"
+        self.src = np.arange(len(self.freqs))
+        self.dst = self.src
+        self.samples = len(self.freqs)
+        
+    def learn_layout(self, hops):
+        
+        step = min([hop[3] for hop in hops])
+        f0 = hops[0][1]
+        sizes = [len(hop[5]) for hop in hops]
+        
+        # the grid bin of every hop sample, in concatenated hop order
+        idx = np.concatenate([np.rint((hop[1] + np.arange(len(hop[5])) * hop[3] - f0) / step) 
+            for hop in hops]).astype(np.intp)
+        bins = int(idx.max()) + 1
+        
+        self.hops = len(hops)
+        self.samples = len(idx)
+        self.layout = [(hop[1], len(hop[5])) for hop in hops]
+        self.freqs = f0 + np.arange(bins) * step
+        
+        if (self.overlap == "average"):
+            self.idx = idx
+            self.counts = np.bincount(idx, minlength=bins)
         else:
-            g.fig = plt.figure(g.fig_title)
-            gs = gridspec.GridSpec(g.rows[0], 1)
-            
-        #g.ax1 = g.fig.add_subplot(gs[0:g.rows[1],0])
-        #g.ax2 = g.fig.add_subplot(gs[(g.rows[0]-g.rows[1]):,0])
+            # sort by bin, and within a bin by distance from the hop edge 
+            # (farthest first), then keep the first sample of each bin. 
+            edge = np.concatenate([np.minimum(np.arange(n), n - 1 - np.arange(n)) for n in sizes])
+            order = np.lexsort((-edge, idx))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = (idx[order][1:] != idx[order][:-1])
+            self.src = order[first]
+            self.dst = idx[self.src]
         
-        print("\n{}, {}, {}" .format(g.rows, g.rows[0], g.rows[1]))
-        g.ax1 = g.fig.add_subplot(gs[0:g.rows[1],0])
-        g.ax2 = g.fig.add_subplot(gs[g.rows[1]:g.rows[0],0])
-        #g.ax1 = g.fig.add_subplot(gs[0:1,0])
-        #g.ax2 = g.fig.add_subplot(gs[1:3,0])
+        covered = len(np.unique(idx))
+        print("Sweep layout: {} hops, {} bins, {} overlapping samples ({}), {} gap bins" 
+            .format(self.hops, bins, len(idx) - covered, self.overlap, bins - covered))
         
-        g.ax1.margins(0)
-        g.ax2.margins(0)
-        g.ax1.set_facecolor('#000000')
-        g.ax2.set_facecolor('#000000')
-        g.ax1.set_aspect('auto')
-        g.ax2.set_aspect('auto')
-        g.fig.canvas.draw()
-
+    def assemble(self, values):
         
-        bbox = g.ax2.get_window_extent().transformed(g.fig.dpi_scale_trans.inverted())
-        g.ax2_w, g.ax2_h = int(bbox.width*g.fig.dpi), int(bbox.height*g.fig.dpi)
-        bgnd = Image.new("RGB",(g.ax2_w,g.ax2_h),'#000000') 
-        g.ax2.imshow(bgnd)
+        bins = len(self.freqs)
+        if (self.idx is not None):
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return (np.bincount(self.idx, weights=values, minlength=bins) / 
+                    self.counts).astype(np.float32)
+        db_row = np.full(bins, np.nan, dtype=np.float32)
+        db_row[self.dst] = values[self.src]
+        return db_row
         
-        #print("ax2 window size: width={}, height={}" .format(g.ax2_w, g.ax2_h))
-        #print("bgnd2 image size: width={}, height={}" .format(bg2.size[0],bg2.size[1]))
+    def add_hops(self, hops):
         
+        sweeps = []
+        for hop in hops:
+            if ((self.pending_time is not None) and ((hop[0] != self.pending_time) or
+                (hop[1] <= self.pending[-1][1]))):
+                self.complete(sweeps)
+            self.pending_time = hop[0]
+            self.pending.append(hop)
+            if ((self.hops > 0) and (len(self.pending) >= self.hops)):
+                self.complete(sweeps)
+        return sweeps
         
-        # This is the same code that gets executed by the animation
-        g.ax1.clear()
-        g.ax1.plot(g.x_vals, g.y_vals, color='yellow', linewidth=0.75) 
-        y_min = min(g.y_vals); y_max = max(g.y_vals)
-        y_diff = y_max-y_min; y_margin = y_diff *0.10
-        g.ax1.set_ylim([min(g.y_vals)-y_margin, max(g.y_vals)+y_margin])
-        g.ax1.set_xlim([g.x_vals[0], g.x_vals[-1]])
-        g.fig.canvas.draw()
-                
-        print("done")
+    def flush(self):
         
-    except Exception as e:
+        sweeps = []
+        self.complete(sweeps)
+        return sweeps
         
-        print("\nException occurred in initialize_plot")
-        print(e)
+    def discard(self):
+        
+        self.pending = []
+        self.pending_time = None
+        
+    def complete(self, sweeps):
         
+        if (len(self.pending) == 0):
+            return
         
+        hops = sorted(self.pending, key=lambda hop: hop[1])
+        timestamp = self.pending_time
+        self.discard()
+        
+        if (self.freqs is None):
+            self.learn_layout(hops)
+        elif ((self.layout is not None) and 
+            ([(hop[1], len(hop[5])) for hop in hops] != self.layout)):
+            print("Dropped a sweep with a different hop layout ({} hops)" .format(len(hops)))
+            return
+        
+        values = hops[0][5] if (len(hops) == 1) else np.concatenate([hop[5] for hop in hops])
+        if (len(values) != self.samples):
+            print("Dropped a sweep with {} samples" .format(len(values)))
+            return
+        
+        sweeps.append((timestamp, self.assemble(values)))
+
+
 """############################################################################
 
-    function:   animation_poll 
+    class:      csv_sink 
+
+    Writes csv lines to a file on a background thread, through a large 
+    buffer that is flushed whenever the line queue has been idle for a 
+    second. The reader never waits on the disk. 
+    
+    For unattended captures, the file can be rotated once it reaches 
+    rotate_bytes, or has been open for rotate_s seconds. Rotation happens 
+    between sweeps (where the timestamp changes, or the hop frequency 
+    wraps back to the first hop), so a segment only holds whole sweeps. 
+    The closed segment is renamed to <name>_<start time>.csv and 
+    compressed (gzip or xz) by a second thread, and the capture carries on
+    in a new <name>.csv. 
 
 ############################################################################"""
 
-def animation_poll(i):
+compress_names = ["gzip", "xz", "none"]
 
-    print("\nStarted animation poll at {}" .format(datetime.datetime.now()))
-            
-    try:
+class csv_sink:
+    
+    def __init__(self, path, mode="w", rotate_bytes=0, rotate_s=0, compress="none"):
         
-        # execute this code only while the rtl_power process is running.
-        # while it is running the poll will return None. 
-        if (g.rtl_proc.poll() == None):
-            
-            cur_csv_size = os.path.getsize(g.csv_path)
-            if (g.old_csv_size == cur_csv_size):
-                print("no new data to process yet. Exiting.")
-                return
-
-            g.old_csv_size = cur_csv_size
+        self.path = path
+        self.lines = queue.Queue()
+        self.file = open(path, mode, buffering=(1 << 20))
         
-            update_csv_data()
-            
-            update_waterfall()
-            
+        self.rotate_bytes = rotate_bytes
+        self.rotate_s = rotate_s
+        self.compress = compress
+        self.seg_start = datetime.datetime.now()
+        self.seg_bytes = 0
+        self.last_stamp = None
+        self.last_hz_low = None
+        self.archive = queue.Queue()
+        self.archive_thread = None
+        if ((rotate_bytes > 0) or (rotate_s > 0)):
+            self.archive_thread = threading.Thread(target=self.run_archive, daemon=True)
+            self.archive_thread.start()
+        
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        
+    def write(self, line):
+        
+        self.lines.put(line)
+        
+    def run(self):
+        
+        while (True):
             try:
-                g.ax2.imshow(g.combined_image)
-                g.ax2.set_aspect('auto')
-                g.ax2.set_xlabel("FFT Bins (N)")
-                g.ax2.set_ylabel("Spectrum Sweeps (N)")
-                plt.tight_layout()
-                g.fig.canvas.draw()
-            except:
-                pass
-                
-            update_spectrum()
-            
+                line = self.lines.get(timeout=1.0)
+            except queue.Empty:
+                self.file.flush()
+                continue
+            if (line is None):
+                break
+            if (self.archive_thread is not None):
+                self.check_rotate(line)
+            self.file.write(line)
+            self.seg_bytes += len(line)
+        self.file.close()
+        
+    def check_rotate(self, line):
+        
+        # a new sweep starts where sweep_assembler.add_hops starts one: 
+        # when the 'date, time' changes, or the hop frequency wraps back 
+        # (several sweeps share a stamp when -i is under a second) 
+        fields = line.split(",", 3)
+        try:
+            stamp = fields[0] + fields[1]
+            hz_low = float(fields[2])
+        except (IndexError, ValueError):
+            return
+        new_sweep = ((stamp != self.last_stamp) or (hz_low <= self.last_hz_low))
+        self.last_stamp = stamp
+        self.last_hz_low = hz_low
+        if (not new_sweep):
+            return
+        if (((self.rotate_bytes > 0) and (self.seg_bytes >= self.rotate_bytes)) or 
+            ((self.rotate_s > 0) and ((datetime.datetime.now() - self.seg_start).total_seconds() 
+            >= self.rotate_s))):
+            self.rotate()
+        
+    def rotate(self):
+        
+        self.file.close()
+        name = ("{}_{}" .format(os.path.splitext(self.path)[0], 
+            self.seg_start.strftime("%Y%m%d_%H%M%S")))
+        seg_path = name + ".csv"
+        n = 1
+        while (any([os.path.exists(seg_path + ext) for ext in ("", ".gz", ".xz")])):
+            seg_path = ("{}_{}.csv" .format(name, n))
+            n += 1
+        os.replace(self.path, seg_path)
+        self.file = open(self.path, "w", buffering=(1 << 20))
+        self.seg_start = datetime.datetime.now()
+        self.seg_bytes = 0
+        print("Rotated the csv file to {}" .format(seg_path))
+        if (self.compress != "none"):
+            self.archive.put(seg_path)
+        
+    def run_archive(self):
+        
+        while (True):
+            seg_path = self.archive.get()
+            if (seg_path is None):
+                break
             try:
-                g.ax1.clear()
-                g.ax1.plot(g.x_vals, g.y_vals, color=g.trace_color, linewidth=0.75) 
-                y_min = min(g.y_vals); y_max = max(g.y_vals)
-                print("{:0.1f}, {:0.1f}" .format(y_min, y_max))
-                y_diff = y_max-y_min; y_margin = y_diff *0.10
-                g.ax1.set_ylim([min(g.y_vals)-y_margin, max(g.y_vals)+y_margin])
-                g.ax1.set_xlim([g.x_vals[0], g.x_vals[-1]])
-                g.ax1.set_xlabel("Frequency (MHz)")
-                g.ax1.set_ylabel("Power (dB)")
-                plt.tight_layout()
-                g.fig.canvas.draw()
-            except:
-                pass
-            
-            print("Finished animation poll at {}" .format(datetime.datetime.now()))
-
-            
-            if(g.done):
-                print("\nauto-stop criteria was met.")
-                # stop the animation polling. 
-                g.anim.event_source.stop()
-                g.rtl_proc.terminate()
-                print("The rtl_power subprocess was terminated.")
-                    
-        else:
-            print("rtl_power subprocess finished!")
-            # stop the animation polling. 
-            g.anim.event_source.stop()
-            
-        time.sleep(3)
-
-    except Exception as e:
+                if (self.compress == "xz"):
+                    out_path, opener = seg_path + ".xz", lzma.open
+                else:
+                    out_path, opener = seg_path + ".gz", gzip.open
+                # written under a temporary name, so a half compressed 
+                # segment is never mistaken for a whole one
+                with open(seg_path, "rb") as f_in, opener(out_path + ".part", "wb") as f_out:
+                    shutil.copyfileobj(f_in, f_out, (1 << 20))
+                os.replace(out_path + ".part", out_path)
+                os.remove(seg_path)
+                print("Compressed {}" .format(out_path))
+            except Exception as e:
+                print("\nException occurred in csv_sink.run_archive")
+                print(e)
         
-        print("\nException occurred in animation_poll")
-        print(e)
+    def close(self):
         
- 
+        self.lines.put(None)
+        self.thread.join()
+        if (self.archive_thread is not None):
+            self.archive.put(None)
+            self.archive_thread.join()
 
-"""############################################################################
 
-    function:   update_csv_data 
+"""############################################################################
 
-############################################################################"""
+    class:      rtl_supervisor 
 
-def update_csv_data():
+    Runs rtl_power in pipe mode under supervision. An asyncio loop on a 
+    background thread drains stdout and stderr continuously (so a chatty 
+    rtl_power can never fill a pipe and stall), parses the rows as they 
+    arrive, and sorts the stderr messages into info, warning and error. 
+    
+    A watchdog restarts rtl_power when no new data has arrived for 
+    stall_k sweep intervals (-i, or rtl_power's 10 s default), and a crash
+    (a non-zero exit) is restarted too, after a backoff that doubles with 
+    each restart that does not produce a whole sweep. After max_restarts 
+    such restarts in a row it gives up. A zero exit (e.g. from -e or -1) 
+    is a normal finish and is not restarted. 
+    
+    The csv sink, assembler and watcher carry on across restarts, so the 
+    capture continues in the same file. The partly written last line of a
+    killed process is discarded, and its partial sweep is dropped by the 
+    assembler (its hop layout does not match). 
+    
+    It stands in for both the rtl_power process (poll, terminate) and the
+    reader (read_hops, at_end), and health() describes the process state 
+    for the ui. 
+
+############################################################################"""
+
+rtl_messages = [
+    ("error", ("failed to open", "no supported devices", "usb_claim_interface error", 
+        "cb transfer status", "error")),
+    ("warning", ("warning",)),
+]
+
+class rtl_supervisor:
+    
+    default_interval = 10.0     # rtl_power's default -i
+    stall_min_s = 10.0
+    startup_s = 30.0            # allowed for the first data (tuner setup)
+    backoff_min_s = 1.0
+    backoff_max_s = 60.0
+    line_limit = (1 << 26)      # one hop line of a very fine -f step
+    
+    def __init__(self, cmd, sink=None, watcher=None, interval=0, stall_k=3, 
+        max_restarts=5, name="rtl_power"):
+        
+        self.cmd = cmd
+        self.sink = sink
+        self.watcher = watcher
+        self.name = name
+        self.stall_s = max(stall_k * (interval if (interval > 0) else self.default_interval), 
+            self.stall_min_s)
+        self.max_restarts = max_restarts
+        
+        self.hops = collections.deque()
+        self.eof = False
+        self.returncode = None
+        self.state = "starting"
+        self.restarts = 0           # in total
+        self.failures = 0           # in a row, without a whole sweep
+        self.counts = {"info": 0, "warning": 0, "error": 0}
+        self.last_msg = ""
+        self.last_data = time.monotonic()
+        self.got_data = False
+        self.first_stamp = None
+        self.first_data = None      # monotonic time of the first row, and
+        self.ended = None           # of the end of supervision
+        self.stopping = False
+        self.proc = None
+        
+        self.loop = asyncio.new_event_loop()
+        self.stop_event = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        
+    def run(self):
+        
+        try:
+            self.loop.run_until_complete(self.supervise())
+        except Exception as e:
+            print("\nException occurred in rtl_supervisor")
+            print(e)
+            self.state = "failed"
+        finally:
+            if (self.returncode is None):
+                self.returncode = -1
+            self.loop.close()
+            self.ended = time.monotonic()
+            self.eof = True
+            if (self.watcher is not None):
+                self.watcher.notify()
+            
+    async def supervise(self):
+        
+        if (self.stop_event is None):
+            self.stop_event = asyncio.Event()
+        while (not self.stopping):
+            
+            code = await self.run_once()
+            if (self.stopping):
+                self.state = "stopped"
+                self.returncode = code
+                break
+            if (code == 0):
+                print("{} finished" .format(self.name))
+                self.state = "exited"
+                self.returncode = 0
+                break
+            if (self.failures >= self.max_restarts):
+                print("{} failed {} times in a row, giving up" .format(self.name, self.failures + 1))
+                self.state = "failed"
+                self.returncode = code if (code is not None) else -1
+                break
+            
+            delay = min(self.backoff_min_s * (2 ** self.failures), self.backoff_max_s)
+            self.failures += 1
+            self.restarts += 1
+            self.state = "restarting"
+            print("Restarting {} in {:0.0f} s" .format(self.name, delay))
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        
+    async def run_once(self):
+        
+        # returns the exit code, or None when it was killed for stalling
+        if (self.stopping):
+            return None
+        try:
+            self.proc = await asyncio.create_subprocess_exec(*self.cmd, 
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, 
+                limit=self.line_limit)
+        except OSError as e:
+            print("Could not start {}: {}" .format(self.name, e))
+            self.last_msg = str(e)
+            return -1
+        
+        self.state = "running"
+        self.got_data = False
+        self.first_stamp = None
+        self.last_data = time.monotonic()
+        
+        readers = [asyncio.ensure_future(self.read_stdout(self.proc.stdout)), 
+            asyncio.ensure_future(self.read_stderr(self.proc.stderr))]
+        dog = asyncio.ensure_future(self.watchdog())
+        stop = asyncio.ensure_future(self.stop_event.wait())
+        exited = asyncio.ensure_future(self.proc.wait())
+        
+        await asyncio.wait([exited, dog, stop], return_when=asyncio.FIRST_COMPLETED)
+        stalled = dog.done()
+        if (not exited.done()):
+            self.proc.kill()
+        code = await exited
+        await asyncio.gather(*readers, return_exceptions=True)
+        for task in (dog, stop):
+            task.cancel()
+        
+        if ((not self.stopping) and (not stalled) and (code != 0)):
+            print("{} exited with code {}" .format(self.name, code))
+        return (None if stalled else code)
+        
+    async def read_stdout(self, stream):
+        
+        while (True):
+            line = await stream.readline()
+            if ((len(line) == 0) or (not line.endswith(b"\n"))):
+                # end of output, or the partial last line of a killed process
+                break
+            line = line.decode(errors="replace").rstrip("\r\n") + "\n"
+            hop = parse_csv_line(line)
+            if (hop is None):
+                self.classify(line)
+                continue
+            if (self.sink is not None):
+                self.sink.write(line)
+            self.hops.append(hop)
+            self.last_data = time.monotonic()
+            self.got_data = True
+            if (self.first_data is None):
+                self.first_data = self.last_data
+            if (self.first_stamp is None):
+                self.first_stamp = hop[0]
+            elif (hop[0] != self.first_stamp):
+                # a whole sweep has been delivered since the (re)start
+                self.failures = 0
+            if (self.watcher is not None):
+                self.watcher.notify()
+            
+    async def read_stderr(self, stream):
+        
+        while (True):
+            line = await stream.readline()
+            if (len(line) == 0):
+                break
+            self.classify(line.decode(errors="replace"))
+            
+    def classify(self, line):
+        
+        line = line.strip()
+        if (line == ""):
+            return
+        print(line)
+        kind = "info"
+        for name, patterns in rtl_messages:
+            if any([p in line.lower() for p in patterns]):
+                kind = name
+                break
+        self.counts[kind] += 1
+        if (kind != "info"):
+            self.last_msg = line
+            
+    async def watchdog(self):
+        
+        while (True):
+            await asyncio.sleep(min(self.stall_s / 4.0, 1.0))
+            limit = self.stall_s if self.got_data else max(self.stall_s, self.startup_s)
+            if ((time.monotonic() - self.last_data) > limit):
+                print("{} stalled, no data for {:0.0f} s" .format(self.name, limit))
+                self.last_msg = "stalled"
+                return
+        
+    def read_hops(self):
+        
+        hops = []
+        while (len(self.hops) > 0):
+            hops.append(self.hops.popleft())
+        return hops
+        
+    def at_end(self):
+        
+        return (self.eof and (len(self.hops) == 0))
+        
+    def poll(self):
+        
+        return (self.returncode if self.eof else None)
+        
+    def terminate(self):
+        
+        self.stopping = True
+        if (not self.eof):
+            try:
+                self.loop.call_soon_threadsafe(self.request_stop)
+            except RuntimeError:
+                # the loop has already closed
+                pass
+            self.thread.join(5.0)
+            
+    def request_stop(self):
+        
+        # runs on the loop thread
+        if (self.stop_event is None):
+            self.stop_event = asyncio.Event()
+        self.stop_event.set()
+            
+    def health(self):
+        
+        text = "{}: {}" .format(self.name, self.state)
+        if (self.restarts > 0):
+            text += ", {} restarts" .format(self.restarts)
+        if (self.counts["error"] + self.counts["warning"] > 0):
+            text += ", {} errors, {} warnings" .format(self.counts["error"], self.counts["warning"])
+        if (self.last_msg != ""):
+            text += " (last: {})" .format(self.last_msg)
+        return text
+
+
+"""############################################################################
+
+    class:      sweep_store 
+
+    A compact binary store of the assembled sweeps, as an alternative to 
+    re-parsing the csv text. It is three files next to the capture:
+    
+        <name>.sweeps       float32 rows, one per sweep, all the same bins
+        <name>.sweeps.idx   float64 timestamp of each row (epoch seconds)
+        <name>.sweeps.json  header: bins, frequency start/stop/step, -o offset
+    
+    Both data files are append-only, so a reader can memory-map them while
+    the capture is still being written. A partly written last row is simply
+    not counted. Reopening a capture, or seeking to a time range, then costs
+    a memory-map and a binary search instead of a full text parse. 
+
+############################################################################"""
+
+class sweep_store:
+    
+    def __init__(self, base):
+        
+        self.base = base
+        self.data_path = base + ".sweeps"
+        self.idx_path = base + ".sweeps.idx"
+        self.hdr_path = base + ".sweeps.json"
+        self.header = None
+        self.data_file = None
+        self.idx_file = None
+        
+    def create(self, freqs, offset, mode="wb"):
+        
+        # freqs is the Hz of each bin. The layout is fixed from here on. 
+        step = float(np.median(np.diff(freqs))) if (len(freqs) > 1) else 0.0
+        self.header = {
+            "format": "RTL_SpectrumSweeper sweeps",
+            "version": 1,
+            "dtype": "float32",
+            "bins": int(len(freqs)),
+            "freq_start": float(freqs[0]),
+            "freq_stop": float(freqs[-1]),
+            "freq_step": step,
+            "offset": float(offset),
+        }
+        with open(self.hdr_path, "w") as f:
+            json.dump(self.header, f, indent=4)
+        self.data_file = open(self.data_path, mode)
+        self.idx_file = open(self.idx_path, mode)
+        
+    def open(self):
+        
+        with open(self.hdr_path) as f:
+            self.header = json.load(f)
+        return self
+        
+    def reopen(self, freqs, offset):
+        
+        # opens an existing store to append to, if it has the same layout
+        if (not os.path.isfile(self.hdr_path)):
+            return False
+        self.open()
+        h = self.header
+        if ((h["bins"] != len(freqs)) or (abs(h["freq_start"] - float(freqs[0])) > 0.5) or 
+            (h["offset"] != float(offset))):
+            return False
+        n = self.count()
+        self.data_file = open(self.data_path, "ab")
+        self.idx_file = open(self.idx_path, "ab")
+        # cut off a partly written row
+        self.data_file.truncate(n * 4 * h["bins"])
+        self.idx_file.truncate(n * 8)
+        return True
+        
+    def append(self, sweeps):
+        
+        # the row goes first, so a row is never indexed before it exists
+        for timestamp, db_row in sweeps:
+            self.data_file.write(np.asarray(db_row, dtype=np.float32).tobytes())
+        self.data_file.flush()
+        self.idx_file.write(np.array([t for t, db_row in sweeps], dtype=np.float64).tobytes())
+        self.idx_file.flush()
+        
+    def close(self):
+        
+        if (self.data_file is not None):
+            self.data_file.close()
+            self.idx_file.close()
+            self.data_file = None
+            self.idx_file = None
+        
+    def count(self):
+        
+        row_bytes = 4 * self.header["bins"]
+        return min(os.path.getsize(self.data_path) // row_bytes, 
+            os.path.getsize(self.idx_path) // 8)
+        
+    def freqs(self):
+        
+        h = self.header
+        return h["freq_start"] + np.arange(h["bins"]) * h["freq_step"]
+        
+    def times(self):
+        
+        n = self.count()
+        if (n == 0):
+            return np.zeros(0, dtype=np.float64)
+        return np.memmap(self.idx_path, dtype=np.float64, mode="r", shape=(n,))
+        
+    def rows(self):
+        
+        n = self.count()
+        if (n == 0):
+            return np.zeros((0, self.header["bins"]), dtype=np.float32)
+        return np.memmap(self.data_path, dtype=np.float32, mode="r", 
+            shape=(n, self.header["bins"]))
+        
+    def find_range(self, t_start, t_stop):
+        
+        # returns the row slice covering t_start <= timestamp <= t_stop
+        times = self.times()
+        return slice(int(np.searchsorted(times, t_start, side="left")), 
+            int(np.searchsorted(times, t_stop, side="right")))
+
+
+"""############################################################################
+
+    class:      waterfall_pyramid 
+
+    A level-of-detail pyramid over the whole sweep history of a store, so 
+    that a long capture can be browsed without rendering all of it. Level 
+    0 is the store itself. Each level above it has half the rows, and half
+    the bins down to pyramid_min_bins, keeping the max of each 2x2 block so
+    that short or narrow signals are not lost. Each level is another 
+    append-only float32 file next to the store:
+    
+        <name>.sweeps.lod1 .. <name>.sweeps.lodN
+    
+    update() folds the store rows that are not in the pyramid yet into each
+    level in turn, so it is cheap to call after every append, and it also
+    builds the levels of an existing store from scratch. The file sizes are
+    the only state, so an interrupted update simply carries on. fetch() 
+    reads a block of one level through a cache of fixed size tiles, so a 
+    zoom or pan only reads the tiles that are in view. 
+
+############################################################################"""
+
+pyramid_levels = 20             # level 20 is about 12 days of 1 s sweeps a row
+pyramid_min_bins = 2048         # stop halving the bins (wider than a screen)
+pyramid_tile = (256, 1024)      # rows, bins
+
+class waterfall_pyramid:
+    
+    def __init__(self, store):
+        
+        self.store = store
+        self.bins = [store.header["bins"]]
+        self.fshift = [0]           # number of bin halvings at each level
+        for k in range(pyramid_levels):
+            halve = (self.bins[-1] > pyramid_min_bins)
+            self.bins.append(((self.bins[-1] + 1) // 2) if halve else self.bins[-1])
+            self.fshift.append(self.fshift[-1] + (1 if halve else 0))
+        self.files = {}
+        self.tiles = collections.OrderedDict()
+        self.max_tiles = 256
+        
+    def path(self, level):
+        
+        return ("{}.sweeps.lod{}" .format(self.store.base, level))
+        
+    def reset(self):
+        
+        # a new store was created, so remove the levels of an old one
+        self.close()
+        self.tiles.clear()
+        for k in range(1, pyramid_levels + 1):
+            if (os.path.isfile(self.path(k))):
+                os.remove(self.path(k))
+        
+    def close(self):
+        
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        
+    def count(self, level):
+        
+        if (level == 0):
+            return self.store.count()
+        try:
+            return os.path.getsize(self.path(level)) // (4 * self.bins[level])
+        except OSError:
+            return 0
+        
+    def rows(self, level):
+        
+        if (level == 0):
+            return self.store.rows()
+        n = self.count(level)
+        if (n == 0):
+            return np.zeros((0, self.bins[level]), dtype=np.float32)
+        return np.memmap(self.path(level), dtype=np.float32, mode="r", 
+            shape=(n, self.bins[level]))
+        
+    def reduce(self, rows, level):
+        
+        # rows is an even number of rows of level-1, the result is level
+        pairs = np.fmax(rows[0::2], rows[1::2])
+        if (self.bins[level] == self.bins[level-1]):
+            return pairs
+        if (pairs.shape[1] % 2):
+            pairs = np.concatenate((pairs, np.full((len(pairs), 1), np.nan, 
+                dtype=np.float32)), axis=1)
+        return np.fmax(pairs[:, 0::2], pairs[:, 1::2])
+        
+    def update(self, block=4096):
+        
+        # returns the number of level rows that were added
+        added = 0
+        for k in range(1, pyramid_levels + 1):
+            want = self.count(k - 1) // 2
+            if (want == 0):
+                break
+            have = self.count(k)
+            if (want <= have):
+                continue
+            if (k not in self.files):
+                self.files[k] = open(self.path(k), "ab")
+                # cut off a partly written row from an interrupted update
+                self.files[k].truncate(have * 4 * self.bins[k])
+            src = self.rows(k - 1)
+            for r in range(have, want, block):
+                n = min(block, want - r)
+                self.files[k].write(self.reduce(np.asarray(src[2*r:2*(r+n)]), 
+                    k).tobytes())
+            self.files[k].flush()
+            added += want - have
+        return added
+        
+    def top(self):
+        
+        # the highest level that has any rows
+        k = 0
+        while ((k < pyramid_levels) and (self.count(k + 1) > 0)):
+            k += 1
+        return k
+        
+    def level_for(self, r0, r1, b0, b1, pixels):
+        
+        # the finest level whose block for this view is at most 4 values
+        # per screen pixel, so the cost of a view does not grow with the 
+        # length of the capture
+        top = self.top()
+        for k in range(top + 1):
+            rows = -(-(r1 - r0) >> k)
+            bins = -(-(b1 - b0) >> self.fshift[k])
+            if ((rows * bins) <= (4 * pixels)):
+                return k
+        return top
+        
+    def fetch(self, level, r0, r1, b0, b1):
+        
+        # r0..r1 and b0..b1 are level rows and bins, the result is float32
+        # with nan where the level has no data (yet)
+        th, tw = pyramid_tile
+        out = np.full((max(r1 - r0, 0), max(b1 - b0, 0)), np.nan, dtype=np.float32)
+        n = self.count(level)
+        src = None
+        for tr in range(max(r0, 0) // th, (min(r1, n) + th - 1) // th):
+            for tc in range(max(b0, 0) // tw, (min(b1, self.bins[level]) + tw - 1) // tw):
+                key = (level, tr, tc)
+                tile = self.tiles.get(key)
+                if (tile is None):
+                    if (src is None):
+                        src = self.rows(level)
+                    tile = np.array(src[tr*th:(tr+1)*th, tc*tw:(tc+1)*tw])
+                    # the last row of tiles is still growing, so keep it out
+                    if (len(tile) == th):
+                        self.tiles[key] = tile
+                        if (len(self.tiles) > self.max_tiles):
+                            self.tiles.popitem(last=False)
+                else:
+                    self.tiles.move_to_end(key)
+                rs, cs = tr*th, tc*tw
+                i0, i1 = max(r0, rs), min(r1, rs + len(tile))
+                j0, j1 = max(b0, cs), min(b1, cs + tile.shape[1])
+                if ((i1 > i0) and (j1 > j0)):
+                    out[i0-r0:i1-r0, j0-b0:j1-b0] = tile[i0-rs:i1-rs, j0-cs:j1-cs]
+        return out
+
+
+"""############################################################################
+
+    function:   convert_csv_to_store 
+
+    Converts an existing rtl_power csv file into a sweep_store, reading it
+    in chunks so that multi-GB files never have to fit in memory. 
+
+############################################################################"""
+
+def convert_csv_to_store(csv_path, base, offset=0):
+    
+    print("\nConverting {} to {}.sweeps" .format(csv_path, base))
+    
+    reader = csv_tail_reader(csv_path)
+    assembler = sweep_assembler(g.overlap)
+    store = sweep_store(base)
+    total = os.path.getsize(csv_path)
+    count = 0
+    
+    while (True):
+        hops = reader.read_hops(64 << 20)
+        done = reader.at_end()
+        sweeps = assembler.add_hops(hops)
+        if (done):
+            sweeps += assembler.flush()
+        if (len(sweeps) > 0):
+            if (store.data_file is None):
+                store.create(assembler.freqs, offset)
+            store.append(sweeps)
+            count += len(sweeps)
+            print("{} sweeps ({:0.0f}%)" .format(count, 100.0 * reader.offset / max(total, 1)))
+        if (done):
+            break
+    
+    store.close()
+    print("Converted {} sweeps" .format(count))
+    
+    if (count > 0):
+        pyramid = waterfall_pyramid(store)
+        pyramid.reset()
+        pyramid.update()
+        pyramid.close()
+    return count
+
+
+"""############################################################################
+
+    class:      sweep_watcher 
+
+    Flags new data, so that the gui thread never has to sleep or block. 
+    The pipeline reader waits on 'event', which is set by notify() when 
+    the source (the rtl_supervisor, or a replay) has new rows. The reader 
+    reports each batch of sweeps it reads with sweeps_done(), and the 
+    measured sweep period is used to pace the gui timer: fast enough to 
+    pick up a new sweep well within one sweep period, without spinning. 
+
+############################################################################"""
+
+class sweep_watcher:
+    
+    def __init__(self, sweeptime=0):
+        
+        self.event = threading.Event()
+        self.period = float(sweeptime)      # measured seconds per sweep
+        self.last_time = None
+        
+    def notify(self):
+        
+        self.event.set()
+        
+    def sweeps_done(self, count):
+        
+        now = time.time()
+        if ((self.last_time is not None) and (count > 0)):
+            dt = (now - self.last_time) / count
+            if (self.period <= 0):
+                self.period = dt
+            else:
+                self.period = 0.8*self.period + 0.2*dt
+        self.last_time = now
+        
+    def interval_ms(self):
+        
+        # ten gui checks per sweep, between 20 and 500 ms
+        if (self.period <= 0):
+            return 100
+        return int(min(max(self.period * 100.0, 20), 500))
+
+
+"""############################################################################
+
+    function:   read_new_sweeps 
+
+    Returns the list of (timestamp, db_row) sweeps that were completed since
+    the last call. When the source has ended, the last sweep is completed 
+    with the hops it has. 
+
+############################################################################"""
+
+def read_new_sweeps(ended=False):
+    
+    hops = g.reader.read_hops()
+    sweeps = g.assembler.add_hops(hops)
+    if (ended):
+        # rtl_power has exited, so the last sweep will not get any more hops
+        sweeps += g.assembler.flush()
+    return sweeps
+
+
+"""############################################################################
+
+    class:      sweep_pipeline 
+
+    Moves the work of each new batch of sweeps off the gui thread, in three
+    stages connected by a bounded queue:
+    
+        reader thread   waits for new data, then reads, parses and assembles
+                        the new sweeps (read_new_sweeps)
+        worker thread   folds them into the waterfall, spectrum, store and
+                        detector (process_sweeps)
+        gui             draws the latest state on its timer (animation_poll)
+    
+    When the worker falls behind, the reader does not block: it keeps 
+    adding new sweeps to the batch it is holding (coalescing), and hands it
+    over as soon as the queue has room, so no sweep is lost but there are 
+    fewer, larger batches. The worker changes the shared state only while 
+    holding g.state_lock, and counts each finished batch in 'seq'. The gui 
+    never waits for the lock: if the worker has it, that tick is skipped, 
+    and the next tick draws whatever the newest state is by then. Frames 
+    the gui had no time for are simply never drawn. 
+
+############################################################################"""
+
+class sweep_pipeline:
+    
+    def __init__(self, depth=2):
+        
+        self.batches = queue.Queue(maxsize=depth)
+        self.ready = threading.Event()  # set after each batch
+        self.seq = 0                    # batches processed so far
+        self.finished = False           # the source has ended and all of
+                                        # its sweeps have been processed
+        self.coalesced = 0
+        self.running = True
+        
+        self.reader_thread = threading.Thread(target=self.run_reader, daemon=True)
+        self.worker_thread = threading.Thread(target=self.run_worker, daemon=True)
+        self.reader_thread.start()
+        self.worker_thread.start()
+        
+    def run_reader(self):
+        
+        held = []
+        ended = False
+        try:
+            while (self.running):
+                g.watcher.event.wait(g.watcher.interval_ms() / 1000.0)
+                g.watcher.event.clear()
+                if (not ended):
+                    ended = ((g.rtl_proc.poll() is not None) and g.reader.at_end())
+                    sweeps = read_new_sweeps(ended)
+                    if (len(sweeps) > 0):
+                        g.watcher.sweeps_done(len(sweeps))
+                        held += sweeps
+                if (len(held) > 0):
+                    try:
+                        self.batches.put_nowait(held)
+                        held = []
+                    except queue.Full:
+                        self.coalesced += 1
+                        continue
+                if (ended):
+                    break
+        except Exception as e:
+            print("\nException occurred in sweep_pipeline reader")
+            print(e)
+        # the end of the source (unless the pipeline is being stopped)
+        while (self.running):
+            try:
+                self.batches.put(None, timeout=0.5)
+                break
+            except queue.Full:
+                pass
+        
+    def run_worker(self):
+        
+        while (True):
+            sweeps = self.batches.get()
+            if ((sweeps is None) or (not self.running)):
+                self.finished = True
+                self.ready.set()
+                break
+            with g.state_lock:
+                process_sweeps(sweeps)
+                self.seq += 1
+                if (g.resume and ((time.time() - g.last_checkpoint) >= checkpoint_s)):
+                    save_checkpoint()
+            self.ready.set()
+            if (g.done):
+                # autostop, the rest of the capture is not wanted
+                self.running = False
+                break
+        
+    def stop(self):
+        
+        self.running = False
+        g.watcher.notify()
+        self.reader_thread.join(5.0)
+        # wake the worker if it is waiting, and wait for its last batch
+        try:
+            self.batches.put_nowait(None)
+        except queue.Full:
+            pass
+        self.worker_thread.join(5.0)
+
+
+"""############################################################################
+
+    function:   process_sweeps 
+
+    Folds a batch of new sweeps into the waterfall, the spectrum traces, 
+    the store, the detector, the live viewers and the shared memory. 
+    Called by the sweep_pipeline worker, with g.state_lock held. 
+
+############################################################################"""
+
+def process_sweeps(sweeps):
+    
+    print("\nStarted processing {} sweeps at {}" .format(len(sweeps), datetime.datetime.now()))
+    
+    g.sweep_count += len(sweeps)
+    g.last_time = sweeps[-1][0]
+    
+    update_csv_data(sweeps)
+    
+    update_store(sweeps)
+    
+    update_detector(sweeps)
+    
+    update_waterfall()
+        
+    update_spectrum(sweeps)
+    
+    update_server(sweeps)
+    
+    update_shm(sweeps)
+    
+    print("Finished processing at {}" .format(datetime.datetime.now()))
+
+
+"""############################################################################
+
+    function:   start_rtl_power_process 
+
+############################################################################"""
+
+def start_rtl_power_process():
+    
+    print("\nStarting rtl_power subprocess\n")
+        
+    try:
+        
+        '''#####################################################################
+        IMPORTANT: There is a problem with rtl_power that will occassionally 
+        (or frequently, depending on settings) put "nan" in the csv file. 
+        This causes the heatmap.py to fail. 
+        Always using the '-P' option fixes this problem. 
+        #####################################################################'''
+         
+        print(g.rtl_str)
+        cmd = g.rtl_str.split()
+        print(cmd)
+        
+        g.fig_title = ("RTL_SpectrumSweeper using: '{} {}' for '{}' started {}" 
+            .format(g.opt_str, g.hmp_str, g.rtl_str, datetime.datetime.now()))
+
+        g.assembler = sweep_assembler(g.overlap)
+        
+        if (len(g.devices) > 1):
+            start_rtl_power_devices(cmd)
+            return
+        
+        start_rtl_power_pipe(cmd)
+    
+    except Exception as e:
+        
+        print("\nException occurred in start_rtl_power_process")
+        print(e)
+        
+        
+"""############################################################################
+
+    function:   start_rtl_power_pipe 
+
+    Starts rtl_power writing its rows to stdout (pipe mode). The rows are 
+    parsed as they arrive by an rtl_supervisor, which also restarts it if
+    it crashes or stalls, and copied to the csv file by a csv_sink thread 
+    unless --nocsv was given. This is how rtl_power is always run: when it
+    wrote the csv file itself, nothing could notice a stall, and a restart
+    would have truncated the file. 
+
+############################################################################"""
+
+def start_rtl_power_pipe(cmd):
+    
+    g.watcher = sweep_watcher(g.sweeptime)
+    if (g.resume):
+        resume_capture()
+    if (not g.nocsv):
+        g.sink = csv_sink(g.csv_path, ("a" if g.resume else "w"), g.rotate_bytes, 
+            g.rotate_s, g.compress)
+    
+    g.rtl_proc = rtl_supervisor(cmd, g.sink, g.watcher, g.sweeptime, g.stall_k, 
+        g.restarts)
+    g.reader = g.rtl_proc
+    g.supervisors = [g.rtl_proc]
+    print("done")
+
+
+"""############################################################################
+
+    function:   split_band 
+
+    Splits an rtl_power '-f low:high:step' range into 'count' contiguous 
+    sub-bands with the same step, each covering about the same number of 
+    bins. Returns a list of '-f' strings. A sub-band runs up to, but not 
+    including, the start of the next one. rtl_power rounds each range up 
+    to whole hops though, so neighbouring devices can still share a few 
+    bins at the boundary; those are trimmed when the pieces are stitched. 
+
+############################################################################"""
+
+def split_band(band, count):
+    
+    lo, hi, step = [freq_parse(v) for v in band.split(":")]
+    bins = int(np.ceil((hi - lo) / step))
+    per_band = int(np.ceil(bins / float(count)))
+    
+    bands = []
+    for k in range(count):
+        sub_lo = lo + k * per_band * step
+        sub_hi = min(lo + (k+1) * per_band * step, hi)
+        if (sub_lo < sub_hi):
+            bands.append("{:d}:{:d}:{:d}" .format(int(round(sub_lo)), 
+                int(round(sub_hi)), int(round(step))))
+    return bands
+
+
+"""############################################################################
+
+    function:   start_rtl_power_devices 
+
+    Starts one rtl_power per --devices entry, each sweeping its own part of
+    the -f range in parallel, and all read through pipes. The per-device 
+    sweeps are stitched back together by a multi_device_reader, so the 
+    rest of the program sees a single sweep of the full range. 
+
+############################################################################"""
+
+def start_rtl_power_devices(cmd):
+    
+    if ("-f" not in cmd):
+        print("--devices needs an rtl_power -f range to split")
+        sys.exit(2)
+    
+    f_index = cmd.index("-f") + 1
+    bands = split_band(cmd[f_index], len(g.devices))
+    
+    # drop any -d the user gave, each process gets its own
+    base_cmd = []
+    skip = 0
+    for k in range(len(cmd)):
+        if (skip):
+            skip -= 1
+        elif (cmd[k] == "-d"):
+            skip = 1
+        else:
+            base_cmd.append(cmd[k])
+    f_index = base_cmd.index("-f") + 1
+    n_cmd = len(g.rtl_cmd.split())
+    
+    g.watcher = sweep_watcher(g.sweeptime)
+    if (g.resume):
+        resume_capture()
+    if (not g.nocsv):
+        g.sink = csv_sink(g.csv_path, ("a" if g.resume else "w"), g.rotate_bytes, 
+            g.rotate_s, g.compress)
+    
+    readers = []
+    procs = []
+    for device, band in zip(g.devices, bands):
+        dev_cmd = list(base_cmd)
+        dev_cmd[f_index] = band
+        dev_cmd = dev_cmd[:n_cmd] + ["-d", str(device)] + dev_cmd[n_cmd:]
+        print("device {}: {}" .format(device, " ".join(dev_cmd)))
+        proc = rtl_supervisor(dev_cmd, None, g.watcher, g.sweeptime, g.stall_k, 
+            g.restarts, "device {}" .format(device))
+        procs.append(proc)
+        readers.append(proc)
+    
+    g.rtl_proc = process_group(procs)
+    g.reader = multi_device_reader(readers, g.sink)
+    g.supervisors = procs
+    print("done")
+
+
+"""############################################################################
+
+    class:      process_group 
+
+    Lets several rtl_power processes be polled and terminated as one. The 
+    group counts as finished as soon as any of them has exited (or its 
+    supervisor has given up on it), since the full range can no longer be
+    stitched together without it. 
+
+############################################################################"""
+
+class process_group:
+    
+    def __init__(self, procs):
+        
+        self.procs = procs
+        
+    def poll(self):
+        
+        for proc in self.procs:
+            code = proc.poll()
+            if (code is not None):
+                return code
+        return None
+        
+    def terminate(self):
+        
+        for proc in self.procs:
+            if (proc.poll() is None):
+                proc.terminate()
+
+
+"""############################################################################
+
+    class:      multi_device_reader 
+
+    Assembles the sweeps of each device separately, then merges them by 
+    timestamp into one sweep of the whole range. A merged sweep is made as 
+    soon as every device has a sweep waiting. If one device has fallen 
+    behind, the others' older sweeps are dropped so that the pieces of a 
+    merged sweep are always from the same moment. 
+    
+    Each device's piece is handed on as one hop, all with the timestamp of
+    the merged sweep, so the main assembler puts them together like the 
+    hops of a single rtl_power (trimming where the device bands overlap). 
+    The same hops are written to the csv file as ordinary rtl_power rows, 
+    so --replay, --convert, --browse and --resume read it back as the 
+    stitched sweeps. 
+
+############################################################################"""
+
+class multi_device_reader:
+    
+    def __init__(self, readers, sink=None):
+        
+        self.readers = readers
+        self.sink = sink
+        self.dev_assemblers = [sweep_assembler(g.overlap) for r in readers]
+        self.queues = [collections.deque() for r in readers]
+        self.order = None
+        self.dropped = 0
+        
+    def read_hops(self):
+        
+        for k in range(len(self.readers)):
+            self.queues[k].extend(self.dev_assemblers[k].add_hops(self.readers[k].read_hops()))
+            if (self.readers[k].at_end()):
+                self.queues[k].extend(self.dev_assemblers[k].flush())
+        
+        hops = []
+        while (all([len(q) > 0 for q in self.queues])):
+            
+            t_ref = max([q[0][0] for q in self.queues])
+            for q in self.queues:
+                while ((len(q) > 1) and (q[1][0] <= t_ref)):
+                    q.popleft()
+                    self.dropped += 1
+            
+            if (self.order is None):
+                # device bands in frequency order
+                freqs = [a.freqs for a in self.dev_assemblers]
+                self.order = sorted(range(len(freqs)), key=lambda k: freqs[k][0])
+                print("Stitching {} devices" .format(len(freqs)))
+            
+            pieces = [self.queues[k].popleft() for k in self.order]
+            timestamp = max([p[0] for p in pieces])
+            for k, p in zip(self.order, pieces):
+                freqs = self.dev_assemblers[k].freqs
+                step = (freqs[1] - freqs[0]) if (len(freqs) > 1) else 1.0
+                hop = (timestamp, freqs[0], freqs[-1] + step, step, 0, p[1])
+                hops.append(hop)
+                if (self.sink is not None):
+                    self.sink.write(format_csv_line(hop))
+        
+        return hops
+        
+    def at_end(self):
+        
+        return all([r.at_end() for r in self.readers])
+
+
+"""############################################################################
+
+    function:   wait_for_initial_data 
+
+############################################################################"""
+
+def wait_for_initial_data():
+    
+    print("\nWaiting for initial data ready")
+    
+    if (len(g.y_vals) > 0):
+        # resumed from a checkpoint, so the spectrum is already there
+        g.ready = True
+        print("Ready!")
+        return
+    
+    try:
+        
+        while(True):
+            # block until the csv file changes (this is before the gui 
+            # exists, so there is nothing to keep responsive yet). 
+            g.watcher.event.wait(g.watcher.interval_ms() / 1000.0)
+            g.watcher.event.clear()
+            ended = ((g.rtl_proc.poll() is not None) and g.reader.at_end())
+            sweeps = read_new_sweeps(ended)
+            if (len(sweeps) == 0):
+                if (ended):
+                    print("rtl_power exited before the first sweep was complete")
+                    sys.exit(1)
+                continue
+            g.watcher.sweeps_done(len(sweeps))
+            # the waterfall buffer is sized from the plot window, so these 
+            # are held until initialize_plot has created it. 
+            g.pending_sweeps += sweeps
+            update_spectrum(sweeps)
+            if (len(g.y_vals) > 0):
+                g.ready = True
+                print("Ready!")
+                break
+        
+    except Exception as e:
+        
+        print("\nException occurred in wait_for_initial_data")
+        print(e)
+        
+
+"""############################################################################
+
+    function:   Initialize_plot 
+
+############################################################################"""
+
+def initialize_plot():
+    
+    print("\nInitializing plot... ", end='', flush=True)
+    
+    try:
+        
+        # use tk to get the screen size, and set the plot window to be just 
+        # under the screen size. Note: The reading and setting of display 
+        # sizes on Win10 has not been straightforward. This seems to be 
+        # partly due to dpi scaling on my PC, but other values e.g. from 
+        # get_window_extent don't seem to be correct at all. This needs 
+        # further investigation. The use of "figure" in GridSpec is not 
+        # compatible with Linux. The screen size is read from the tk window
+        # of the figure itself, so only one tk root is ever created. 
+        
+        if (g.headless):
+            # no display, so the figure is simply the requested image size
+            dpi = 100.0
+            g.fig = plt.figure(g.fig_title, 
+                figsize=(g.out_size[0]/dpi, g.out_size[1]/dpi), dpi=dpi)
+            gs = gridspec.GridSpec(g.rows[0], 1, figure=g.fig)
+            
+        elif (platform.system() == "Windows"):
+            g.fig = plt.figure(g.fig_title)
+            window = getattr(g.fig.canvas.manager, "window", None)
+            if (hasattr(window, "winfo_screenmmwidth")):
+                g.scrn_width_in = window.winfo_screenmmwidth() / 25.4
+                g.scrn_height_in = window.winfo_screenmmheight() / 25.4
+                g.fig.set_size_inches(g.scrn_width_in, g.scrn_height_in*0.9, forward=True)
+            gs = gridspec.GridSpec(g.rows[0], 1, figure=g.fig)
+        else:
+            g.fig = plt.figure(g.fig_title)
+            gs = gridspec.GridSpec(g.rows[0], 1)
+            
+        #g.ax1 = g.fig.add_subplot(gs[0:g.rows[1],0])
+        #g.ax2 = g.fig.add_subplot(gs[(g.rows[0]-g.rows[1]):,0])
+        
+        print("\n{}, {}, {}" .format(g.rows, g.rows[0], g.rows[1]))
+        g.ax1 = g.fig.add_subplot(gs[0:g.rows[1],0])
+        g.ax2 = g.fig.add_subplot(gs[g.rows[1]:g.rows[0],0])
+        #g.ax1 = g.fig.add_subplot(gs[0:1,0])
+        #g.ax2 = g.fig.add_subplot(gs[1:3,0])
+        
+        g.ax1.margins(0)
+        g.ax2.margins(0)
+        g.ax1.set_facecolor('#000000')
+        g.ax2.set_facecolor('#000000')
+        g.ax1.set_aspect('auto')
+        g.ax2.set_aspect('auto')
+        g.ax1.set_xlabel("Frequency (MHz)")
+        g.ax1.set_ylabel("Power (dB)")
+        g.ax2.set_xlabel("FFT Bins (N)")
+        g.ax2.set_ylabel("Spectrum Sweeps (N)")
+        if (len(g.supervisors) > 0):
+            g.health_text = g.fig.text(0.995, 0.995, "", ha='right', va='top', 
+                fontsize='small', animated=g.blit)
+            update_health()
+        plt.tight_layout()
+        g.fig.canvas.draw()
+
+        
+        measure_axes()
+        g.spec_dec = bin_decimator(len(g.assembler.freqs))
+        g.spec_dec.plan(0, len(g.assembler.freqs), g.ax1_w)
+        allocate_waterfall(len(g.assembler.freqs))
+        restore_waterfall()
+        g.sweep_count += len(g.pending_sweeps)
+        if (len(g.pending_sweeps) > 0):
+            g.last_time = g.pending_sweeps[-1][0]
+        update_csv_data(g.pending_sweeps)
+        update_store(g.pending_sweeps)
+        update_detector(g.pending_sweeps)
+        update_server(g.pending_sweeps)
+        update_shm(g.pending_sweeps)
+        g.pending_sweeps = []
+        update_waterfall()
+        
+        #print("ax2 window size: width={}, height={}" .format(g.ax2_w, g.ax2_h))
+        
+        
+        # The trace and the waterfall image are created once here. After 
+        # this the animation only changes their data. When blitting, they
+        # are 'animated' so that a full draw leaves them out of the cached 
+        # background, and they are drawn on top of it by on_draw. 
+        for name in g.traces:
+            color = g.trace_color if (name == "avg") else trace_colors[name]
+            x, y = g.spec_dec.envelope(g.x_vals, g.spectrum.trace(name))
+            g.lines[name], = g.ax1.plot(x, y, color=color, linewidth=0.75, animated=g.blit, label=name)
+        if (len(g.traces) > 1):
+            g.ax1.legend(loc='upper right', fontsize='small', facecolor='#000000', 
+                labelcolor='#FFFFFF')
+        g.sel_line, = g.ax1.plot([], [], color='#00FF00', linewidth=0.75, animated=g.blit, 
+            visible=False)
+        g.sel_marker = g.ax2.axhline(0, color='#00FF00', linewidth=0.75, animated=g.blit, 
+            visible=False)
+        g.sel_text = g.ax1.text(0.005, 0.98, "", color='#00FF00', ha='left', va='top', 
+            fontsize='small', transform=g.ax1.transAxes, animated=g.blit)
+        g.ax1.set_xlim([g.x_vals[0], g.x_vals[-1]])
+        update_spectrum_ylim(True)
+        g.wf_image = g.ax2.imshow(g.combined_image, animated=g.blit, 
+            extent=waterfall_extent())
+        g.ax2.set_aspect('auto')
+        
+        g.fig.canvas.mpl_connect('draw_event', on_draw)
+        g.fig.canvas.mpl_connect('resize_event', on_resize)
+        g.ax1.callbacks.connect('xlim_changed', on_xlim_changed)
+        g.ax2.callbacks.connect('xlim_changed', on_xlim_changed)
+        g.ax2.format_coord = waterfall_coord
+        g.fig.canvas.mpl_connect('button_press_event', on_waterfall_click)
+        g.fig.canvas.draw()
+                
+        print("done")
+        print("First frame drawn {:0.2f} s after start" .format(time.time() - g.start_time))
+        
+    except Exception as e:
+        
+        print("\nException occurred in initialize_plot")
+        print(e)
+        
+        
+"""############################################################################
+
+    function:   measure_axes 
+
+############################################################################"""
+
+def measure_axes():
+    
+    bbox = g.ax1.get_window_extent().transformed(g.fig.dpi_scale_trans.inverted())
+    g.ax1_w, g.ax1_h = int(bbox.width*g.fig.dpi), int(bbox.height*g.fig.dpi)
+    bbox = g.ax2.get_window_extent().transformed(g.fig.dpi_scale_trans.inverted())
+    g.ax2_w, g.ax2_h = int(bbox.width*g.fig.dpi), int(bbox.height*g.fig.dpi)
+
+
+"""############################################################################
+
+    function:   on_draw / on_resize 
+
+    Every full draw of the figure (the first one, a resize, or a change of
+    the axis limits) saves the figure without the animated artists as the
+    blitting background, and then draws the artists on top of it. The 
+    layout is only recomputed when the window is resized, and the display
+    decimation only when the window is resized or an axis is zoomed. 
+
+############################################################################"""
+
+def on_draw(event):
+    
+    if (g.blit):
+        g.blit_bg = g.fig.canvas.copy_from_bbox(g.fig.bbox)
+        draw_animated()
+
+
+def on_resize(event):
+    
+    try:
+        plt.tight_layout()
+        measure_axes()
+        plan_display()
+    except Exception as e:
+        print("\nException occurred in on_resize")
+        print(e)
+
+
+def on_xlim_changed(ax):
+    
+    try:
+        plan_display()
+    except Exception as e:
+        print("\nException occurred in on_xlim_changed")
+        print(e)
+
+
+def draw_animated():
+    
+    for name in g.traces:
+        g.ax1.draw_artist(g.lines[name])
+    g.ax1.draw_artist(g.sel_line)
+    g.ax1.draw_artist(g.sel_text)
+    g.ax2.draw_artist(g.wf_image)
+    g.ax2.draw_artist(g.sel_marker)
+    if (g.health_text is not None):
+        g.fig.draw_artist(g.health_text)
+
+
+"""############################################################################
+
+    function:   plan_display 
+
+    Fits the decimators to the visible bins and the current pixel width of
+    each axes, and when a plan changes, pushes the re-decimated traces or
+    waterfall into the artists. The redraw is left to the resize or zoom 
+    that called this. If the pipeline worker is busy with the state, the
+    plan is left to the next animation_poll tick. 
+
+############################################################################"""
+
+def plan_display():
+    
+    if ((g.spec_dec is None) or g.replanning):
+        return
+    if (not g.state_lock.acquire(blocking=False)):
+        g.replan_pending = True
+        return
+    
+    g.replanning = True
+    try:
+        
+        # the spectrum x axis is in MHz, keep one bin beyond each edge
+        lo, hi = g.ax1.get_xlim()
+        i0 = int(np.searchsorted(g.x_vals, min(lo, hi))) - 1
+        i1 = int(np.searchsorted(g.x_vals, max(lo, hi))) + 1
+        if (g.spec_dec.plan(i0, i1, g.ax1_w)):
+            for name in g.traces:
+                g.lines[name].set_data(*g.spec_dec.envelope(g.x_vals, g.spectrum.trace(name)))
+            update_selection()
+        
+        # the waterfall x axis is in bins, bin i is drawn from i-0.5 to i+0.5
+        lo, hi = g.ax2.get_xlim()
+        i0 = int(np.floor(min(lo, hi) + 0.5))
+        i1 = int(np.ceil(max(lo, hi) + 0.5))
+        if (g.wf_dec.plan(i0, i1, g.ax2_w)):
+            if (g.scale is not None):
+                g.wf.relevel(g.scale)
+            update_waterfall()
+            g.wf_image.set_data(g.combined_image)
+            g.wf_image.set_extent(waterfall_extent())
+            
+    finally:
+        g.replanning = False
+        g.state_lock.release()
+
+
+def waterfall_extent():
+    
+    # the image only covers the decimated bins, but is placed in bin units
+    h = g.combined_image.shape[0]
+    return (g.wf_dec.i0-0.5, g.wf_dec.i1-0.5, h-0.5, -0.5)
+
+
+"""############################################################################
+
+    function:   update_spectrum_ylim 
+
+    Sets the spectrum y-axis limits (with a 10% margin) only when the traces
+    no longer fit inside them, or when they have shrunk to less than half of
+    their span. Returns True if the limits were changed. 
+
+############################################################################"""
+
+def update_spectrum_ylim(force=False):
+    
+    y_min = min([float(np.nanmin(g.spectrum.trace(name))) for name in g.traces])
+    y_max = max([float(np.nanmax(g.spectrum.trace(name))) for name in g.traces])
+    print("{:0.1f}, {:0.1f}" .format(y_min, y_max))
+    y_diff = y_max-y_min; y_margin = y_diff *0.10
+    
+    lo, hi = g.ax1.get_ylim()
+    if ((not force) and (y_min >= lo) and (y_max <= hi) and 
+        (y_diff >= (hi-lo)*g.ylim_band)):
+        return False
+    
+    g.ax1.set_ylim([y_min-y_margin, y_max+y_margin])
+    return True
+
+
+"""############################################################################
+
+    function:   update_plot 
+
+    Pushes the new trace and waterfall data into the existing artists. When
+    nothing but the data has changed, only the two artists are redrawn and
+    blitted over the saved background. Otherwise the whole figure is drawn.
+
+############################################################################"""
+
+def update_plot():
+    
+    try:
+        
+        full_draw = False
+        
+        for name in g.traces:
+            g.lines[name].set_data(*g.spec_dec.envelope(g.x_vals, g.spectrum.trace(name)))
+        update_selection()
+        if (update_spectrum_ylim()):
+            full_draw = True
+        
+        g.wf_image.set_data(g.combined_image)
+        extent = waterfall_extent()
+        if (tuple(g.wf_image.get_extent()) != extent):
+            g.replanning = True
+            try:
+                g.wf_image.set_extent(extent)
+            finally:
+                g.replanning = False
+            full_draw = True
+        
+        if (g.headless):
+            # nothing is shown, the figure is only drawn by savefig
+            pass
+        elif (full_draw or (not g.blit) or (g.blit_bg is None)):
+            g.fig.canvas.draw_idle()
+        else:
+            g.fig.canvas.restore_region(g.blit_bg)
+            draw_animated()
+            g.fig.canvas.blit(g.fig.bbox)
+            g.fig.canvas.flush_events()
+        
+    except Exception as e:
+        
+        print("\nException occurred in update_plot")
+        print(e)
+
+
+"""############################################################################
+
+    function:   health_line / update_health 
+
+    Puts the state of the supervised rtl_power processes (running, 
+    restarting, restarts, errors) in a line at the top right of the figure. 
+    Returns True when it has changed. 
+
+############################################################################"""
+
+def health_line():
+    
+    return "   ".join([s.health() for s in g.supervisors])
+
+
+def update_health():
+    
+    health = health_line()
+    if (health == g.health):
+        return False
+    g.health = health
+    if (g.health_text is not None):
+        g.health_text.set_text(health)
+    return True
+
+
+"""############################################################################
+
+    function:   waterfall_coord / on_waterfall_click / update_selection 
+
+    The cursor readout of the waterfall. Hovering over it shows the 
+    frequency (MHz, with the -o offset), time and power under the mouse in
+    the toolbar, read from the dB values and the timestamp index of the 
+    waterfall buffer (not from the colorized image, which is decimated). 
+    Each lookup is a direct index into those arrays. 
+    
+    Clicking a row selects that sweep and shows it in the spectrum axes, 
+    with a marker on its waterfall row (a right click clears it). The 
+    selection is kept by timestamp, since the row of a sweep moves as the
+    waterfall scrolls, and is found again on each update by a binary search
+    of the timestamp index. Only the selected row is read, so the cost does
+    not depend on how many sweeps the capture has. 
+
+############################################################################"""
+
+def waterfall_cell(x, y):
+    
+    # returns the (row, bin) of the waterfall view under x, y, or None
+    row = int(np.floor(y + 0.5))
+    col = int(np.floor(x + 0.5))
+    if ((row < 0) or (row >= g.wf.filled()) or (col < 0) or (col >= g.wf.bins)):
+        return None
+    return (row, col)
+
+
+def waterfall_coord(x, y):
+    
+    cell = waterfall_cell(x, y)
+    if (cell is None):
+        return ""
+    row, col = cell
+    k = g.wf.first_slot() + row
+    return ("{:0.6f} MHz   {}   {:0.1f} dB   sweep {}" .format(g.x_vals[col], 
+        datetime.datetime.fromtimestamp(g.wf.times[k]).strftime("%Y-%m-%d %H:%M:%S"), 
+        g.wf.db[k, col], g.sweep_count - g.wf.filled() + row + 1))
+
+
+def on_waterfall_click(event):
+    
+    try:
+        
+        if ((event.inaxes is not g.ax2) or (event.ydata is None)):
+            return
+        # ignore clicks that zoom or pan
+        toolbar = getattr(g.fig.canvas, "toolbar", None)
+        if ((toolbar is not None) and getattr(toolbar, "mode", "")):
+            return
+        
+        if (event.button == 3):
+            g.selected = None
+        else:
+            cell = waterfall_cell(event.xdata, event.ydata)
+            if (cell is None):
+                return
+            times = g.wf.times_view()
+            t = times[cell[0]]
+            # the rank among sweeps with the same (one second) timestamp
+            g.selected = (float(t), cell[0] - int(np.searchsorted(times, t)))
+        # drawn (under the state lock) by the next animation_poll tick
+        g.select_pending = True
+        
+    except Exception as e:
+        
+        print("\nException occurred in on_waterfall_click")
+        print(e)
+
+
+def update_selection():
+    
+    # called with the state lock held
+    row = None
+    if (g.selected is not None):
+        times = g.wf.times_view()
+        t, rank = g.selected
+        row = int(np.searchsorted(times, t)) + rank
+        if ((row >= len(times)) or (times[row] != t)):
+            # it has scrolled out of the waterfall
+            print("The selected sweep is no longer in the waterfall")
+            g.selected = None
+            row = None
+    
+    if (row is None):
+        g.sel_line.set_visible(False)
+        g.sel_marker.set_visible(False)
+        g.sel_text.set_text("")
+        return
+    
+    db_row = g.wf.db[g.wf.first_slot() + row]
+    g.sel_line.set_data(*g.spec_dec.envelope(g.x_vals, db_row))
+    g.sel_line.set_visible(True)
+    g.sel_marker.set_ydata([row, row])
+    g.sel_marker.set_visible(True)
+    g.sel_text.set_text("sweep at {}" .format(
+        datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S")))
+
+
+"""############################################################################
+
+    function:   animation_poll 
+
+############################################################################"""
+
+def animation_poll(i):
+            
+    try:
+        
+        # the timer runs much faster than the sweeps, so most ticks only 
+        # check whether the pipeline has a newer state than the one drawn, 
+        # or a restart or stall of rtl_power needs showing. 
+        seq = g.pipeline.seq
+        if ((seq == g.drawn_seq) and (not g.replan_pending) and (not g.select_pending) and 
+            (not g.pipeline.finished) and (not g.done) and (g.health == health_line())):
+            return
+        
+        # the worker is busy, so this tick is skipped and a later one draws
+        # its newest state (the gui never waits for it) 
+        if (not g.state_lock.acquire(blocking=False)):
+            return
+        try:
+            g.pipeline.ready.clear()
+            seq = g.pipeline.seq
+            if (g.replan_pending):
+                g.replan_pending = False
+                plan_display()
+            g.select_pending = False
+            update_health()
+            update_plot()
+            g.drawn_seq = seq
+            
+            if (g.headless and (g.save_every > 0) and 
+                ((g.sweep_count - g.last_save) >= g.save_every)):
+                save_outputs()
+        finally:
+            g.state_lock.release()
+        
+        # follow the measured sweep period
+        if (g.anim.interval != g.watcher.interval_ms()):
+            g.anim.interval = g.watcher.interval_ms()
+            
+        if (g.done):
+            print("\nauto-stop criteria was met.")
+            # stop the animation polling. 
+            g.anim.stop()
+            g.pipeline.stop()
+            g.rtl_proc.terminate()
+            print("The rtl_power subprocess was terminated.")
+            save_outputs()
+                
+        elif (g.pipeline.finished and (g.drawn_seq == g.pipeline.seq)):
+            print("rtl_power subprocess finished!")
+            # stop the animation polling. 
+            g.anim.stop()
+            if (not g.plan_band):
+                # (a plan band carries on at its next visit)
+                save_outputs()
+
+    except Exception as e:
+        
+        print("\nException occurred in animation_poll")
+        print(e)
+        
+ 
+
+"""############################################################################
+
+    function:   build_palette 
+
+    Returns the color palette as an (N,3) uint8 numpy array that is used as
+    a lookup table to turn dB values into RGB pixels. These are the same 
+    palettes that heatmap.py provides. 
+
+############################################################################"""
+
+palette_names = ["default", "extended", "charolastra", "twente", "custom"]
+
+def build_palette(name, rgbxy):
+    
+    p = []
+    
+    if (name == "extended"):
+        p.append((0, 0, 50))
+        for i in range(1, 256):
+            p.append((i, i-1, 50))
+            p.append((i-1, i, 50))
+            p.append((i, i, 50))
+            
+    elif (name == "charolastra"):
+        for i in range(1024):
+            v = i / 1023.0
+            c = colorsys.hsv_to_rgb(0.65-(v-0.08), 1, 0.2+v)
+            p.append((int(c[0]*256), int(c[1]*256), int(c[2]*256)))
+            
+    elif (name == "twente"):
+        for i in range(20, 100, 2):
+            p.append((0, 0, i))
+        for i in range(256):
+            v = i / 255.0
+            p.append((int(v*255), 0, int(v*155)+100))
+        for i in range(256):
+            p.append((255, i, 255))
+        # intentionally blow out the highs
+        for i in range(100):
+            p.append((255, 255, 255))
+            
+    elif (name == "custom"):
+        # fade from black at index X (contrast) to the R:G:B color at 
+        # index Y (brightness), and hold the full color above Y. 
+        R,G,B,X,Y = rgbxy
+        for i in range(256):
+            v = min(max((i - X) / float(Y - X), 0.0), 1.0)
+            p.append((int(R*v), int(G*v), int(B*v)))
+            
+    else:
+        for i in range(256):
+            p.append((i, i, 50))
+    
+    return np.clip(np.array(p), 0, 255).astype(np.uint8)
+
+
+"""############################################################################
+
+    function:   colorize 
+
+    Converts an (N,bins) array of dB values into an (N,bins,3) array of RGB
+    pixels, scaling db_min..db_max across the whole palette. Missing (nan)
+    values are drawn black. 
+
+############################################################################"""
+
+def colorize(db_rows, palette, db_min, db_max):
+    
+    span = max(db_max - db_min, 1e-6)
+    tone = (db_rows - db_min) * ((len(palette) - 1) / span)
+    idx = np.clip(np.nan_to_num(tone, nan=0.0), 0, len(palette) - 1).astype(np.intp)
+    rgb = palette[idx]
+    rgb[np.isnan(db_rows)] = 0
+    return rgb
+
+
+"""############################################################################
+
+    class:      bin_decimator 
+
+    Reduces the visible bins to one column per pixel of the axes, so that 
+    a sweep with hundreds of thousands of bins is not drawn point by point.
+    The plan (the visible bin range and the first bin of each column) only
+    changes on a resize or zoom, and applying it to new data is a single 
+    numpy reduceat. The traces are drawn as a min/max envelope and the 
+    waterfall keeps the peak of each column, so a carrier narrower than a
+    pixel is not lost between columns. The accumulators, the waterfall 
+    buffer, the store and the saved png all keep the full resolution. 
+
+############################################################################"""
+
+class bin_decimator:
+    
+    def __init__(self, bins):
+        
+        self.bins = bins
+        self.i0 = 0                 # visible bins are i0 .. i1-1
+        self.i1 = bins
+        self.cols = bins
+        self.starts = np.arange(bins)
+        self.active = False         # False when every bin has its own pixel
+        
+    def plan(self, i0, i1, width):
+        
+        # returns True if the plan changed
+        i0 = min(max(int(i0), 0), self.bins - 1)
+        i1 = min(max(int(i1), i0 + 1), self.bins)
+        cols = min(i1 - i0, max(int(width), 1))
+        if ((i0, i1, cols) == (self.i0, self.i1, self.cols)):
+            return False
+        self.i0, self.i1, self.cols = i0, i1, cols
+        self.starts = i0 + (np.arange(cols) * (i1 - i0)) // cols
+        self.active = (cols < (i1 - i0))
+        return True
+        
+    def peak(self, values):
+        
+        # values is (..., bins), the result is (..., cols). fmax skips nan.
+        if (not self.active):
+            return values[..., self.i0:self.i1]
+        return np.fmax.reduceat(values[..., :self.i1], self.starts, axis=-1)
+        
+    def envelope(self, x, values):
+        
+        # returns the x and y data of a trace, with each column drawn as a 
+        # vertical stroke from its min to its max
+        if (not self.active):
+            return x[self.i0:self.i1], values[self.i0:self.i1]
+        lo = np.fmin.reduceat(values[:self.i1], self.starts)
+        hi = np.fmax.reduceat(values[:self.i1], self.starts)
+        return np.repeat(x[self.starts], 2), np.column_stack((lo, hi)).ravel()
+
+
+"""############################################################################
+
+    class:      color_scale 
+
+    Tracks the dB range that the waterfall colors span with a streaming 
+    quantile sketch. Every value is quantized to a level on a fixed 
+    scale_step_db grid (level 0 means no data), and the sketch is a 
+    histogram of the levels that decays by a little with each sweep, so it
+    follows slow changes while a short burst hardly moves it. Adding a 
+    sweep is one bincount over its bins, and the quantiles are read from 
+    the cumulative histogram, whose size does not depend on the capture. 
+    
+    The colors come from a lookup table of level -> RGB, that spreads the
+    palette (including the --rgbxy X/Y indices) over the range between the
+    low and high quantiles. The table is only rebuilt when a quantile has 
+    drifted more than scale_drift_db from it, and the stored levels are 
+    then recolored with a single numpy take, with no dB math at all. 
+
+############################################################################"""
+
+scale_step_db = 0.25
+scale_floor_db = -200.0
+scale_levels = 2048             # -200 dB to about +311 dB
+scale_quantiles = (0.05, 0.995)
+scale_halflife = 500            # sweeps
+scale_drift_db = 2.0
+scale_min_span_db = 1.0
+
+class color_scale:
+    
+    def __init__(self, palette, quantiles=scale_quantiles):
+        
+        self.palette = palette
+        self.quantiles = quantiles
+        self.hist = np.zeros(scale_levels, dtype=np.float64)
+        self.decay = 0.5 ** (1.0 / scale_halflife)
+        self.db_min = None
+        self.db_max = None
+        self.lut = None
+        self.level_db = scale_floor_db + (np.arange(scale_levels) - 1) * scale_step_db
+        
+    def levels(self, db):
+        
+        lv = np.rint((db - scale_floor_db) * (1.0 / scale_step_db)) + 1
+        lv = np.clip(np.nan_to_num(lv, nan=0.0), 0, scale_levels - 1).astype(np.uint16)
+        lv[np.isnan(db)] = 0
+        return lv
+        
+    def add(self, lv_rows):
+        
+        # lv_rows is (N,bins), each sweep decays the older ones
+        self.hist *= self.decay ** len(lv_rows)
+        self.hist += np.bincount(lv_rows.ravel(), minlength=scale_levels)[:scale_levels]
+        self.hist[0] = 0
+        
+    def quantile_range(self):
+        
+        c = np.cumsum(self.hist)
+        if (c[-1] <= 0):
+            return None
+        k = np.searchsorted(c, [q * c[-1] for q in self.quantiles])
+        lo, hi = self.level_db[k[0]], self.level_db[k[1]]
+        return (float(lo), float(max(hi, lo + scale_min_span_db)))
+        
+    def update(self):
+        
+        # returns True when the table was rebuilt
+        qr = self.quantile_range()
+        if (qr is None):
+            return False
+        if ((self.lut is not None) and (abs(qr[0] - self.db_min) <= scale_drift_db) and 
+            (abs(qr[1] - self.db_max) <= scale_drift_db)):
+            return False
+        self.db_min, self.db_max = qr
+        self.lut = colorize(self.level_db, self.palette, self.db_min, self.db_max)
+        self.lut[0] = 0
+        print("Color scale: {:0.1f} to {:0.1f} dB" .format(self.db_min, self.db_max))
+        return True
+
+
+"""############################################################################
+
+    class:      waterfall_buffer 
+
+    Holds the waterfall in preallocated arrays: the dB value of every bin,
+    and for each column of the decimator the color_scale level (needed to 
+    recolor when the color range changes) and the RGB pixel that is 
+    displayed, plus the timestamp of every row. Rows are written in place,
+    so nothing is reallocated as the sweep runs. 
+    
+    When scrolling (autostop disabled) the buffer is circular. Every row is
+    written twice, at slot k and at slot k+rows, so that the newest 'rows'
+    sweeps are always available as one contiguous slice of the arrays. 
+    This lets the image be displayed without copying or rolling it. 
+
+############################################################################"""
+
+class waterfall_buffer:
+    
+    def __init__(self, rows, bins, scroll, decimator):
+        
+        self.rows = rows            # capacity in sweeps
+        self.bins = bins
+        self.scroll = scroll
+        self.decimator = decimator
+        self.count = 0              # total number of rows written
+        
+        slots = (2 * rows) if scroll else rows
+        self.db = np.full((slots, bins), np.nan, dtype=np.float32)
+        self.times = np.zeros(slots, dtype=np.float64)
+        self.lv = np.zeros((slots, decimator.cols), dtype=np.uint16)
+        self.rgb = np.zeros((slots, decimator.cols, 3), dtype=np.uint8)
+        
+    def filled(self):
+        
+        return min(self.count, self.rows)
+        
+    def append(self, times, db_rows, lv_rows, rgb_rows=None):
+        
+        for i in range(len(db_rows)):
+            if (self.scroll):
+                k = self.count % self.rows
+                slots = (k, k + self.rows)
+            elif (self.count < self.rows):
+                slots = (self.count,)
+            else:
+                break   # full, and not scrolling
+            for k in slots:
+                self.db[k] = db_rows[i]
+                self.times[k] = times[i]
+                self.lv[k] = lv_rows[i]
+                if (rgb_rows is not None):
+                    self.rgb[k] = rgb_rows[i]
+            self.count += 1
+            
+    def recolor(self, lut):
+        
+        np.take(lut, self.lv, axis=0, out=self.rgb)
+        
+    def relevel(self, scale):
+        
+        # after the decimator plan has changed, the column levels are redone
+        # from the dB values
+        if (self.rgb.shape[1] != self.decimator.cols):
+            self.rgb = np.zeros((len(self.db), self.decimator.cols, 3), dtype=np.uint8)
+        self.lv = self.decimator.peak(scale.levels(self.db))
+        if (scale.lut is not None):
+            self.recolor(scale.lut)
+        
+    def first_slot(self):
+        
+        if (self.scroll and (self.count > self.rows)):
+            return self.count % self.rows
+        return 0
+        
+    def view(self, height):
+        
+        # returns 'height' rows (at most 'rows') in time order, oldest first.
+        # Rows that have not been written yet are black. 
+        k = self.first_slot()
+        return self.rgb[k:k + min(max(height, 1), self.rows)]
+        
+    def db_view(self):
+        
+        k = self.first_slot()
+        return self.db[k:k + self.filled()]
+        
+    def times_view(self):
+        
+        # the timestamps of db_view, in time order (so binary searchable)
+        k = self.first_slot()
+        return self.times[k:k + self.filled()]
+
+
+"""############################################################################
+
+    function:   update_csv_data 
+
+    Adds the new sweeps to the waterfall image and to the color_scale 
+    sketch. Only the new rows are colorized, unless the color range has 
+    drifted, in which case every stored row is recolored through the new 
+    lookup table. 
+
+############################################################################"""
+
+def update_csv_data(sweeps):
     
     print("Updating csv data")
     
+    if (len(sweeps) == 0):
+        # e.g. resumed with no sweeps after the checkpoint
+        return
+    
+    try:
+        
+        if (g.palette is None):
+            g.palette = build_palette(g.palette_name, g.rgbxy)
+        if (g.scale is None):
+            g.scale = color_scale(g.palette)
+        
+        times = [timestamp for timestamp, db_row in sweeps]
+        new_rows = np.array([db_row for timestamp, db_row in sweeps], dtype=np.float32)
+        lv_rows = g.scale.levels(new_rows)
+        g.scale.add(lv_rows)
+        # level 0 (no data) is the lowest, so the peak of each column can 
+        # be taken on the levels
+        lv_cols = g.wf_dec.peak(lv_rows)
+        
+        if (g.scale.update()):
+            g.db_min, g.db_max = g.scale.db_min, g.scale.db_max
+            g.wf.append(times, new_rows, lv_cols)
+            g.wf.recolor(g.scale.lut)
+        else:
+            g.wf.append(times, new_rows, lv_cols, g.scale.lut[lv_cols])
+        
+    except Exception as e:
+        
+        print("\nException occurred in update_csv_data")
+        print(e)
+
+
+"""############################################################################
+
+    function:   save_waterfall_png 
+
+############################################################################"""
+
+def save_waterfall_png():
+    
+    try:
+        
+        if ((g.wf is not None) and (g.wf.count > 0)):
+            fstr = ("{}.png" .format(g.filename))
+            # the display is decimated, so the png is colorized from the 
+            # full resolution dB values
+            Image.fromarray(g.scale.lut[g.scale.levels(g.wf.db_view())]).save(fstr)
+            print("Saved waterfall image to {}" .format(fstr))
+        
+    except Exception as e:
+        
+        print("\nException occurred in save_waterfall_png")
+        print(e)
+
+
+"""############################################################################
+
+    function:   update_store 
+
+############################################################################"""
+
+def update_store(sweeps):
+    
+    if (not g.use_store):
+        return
+    
+    try:
+        
+        if (g.store is None):
+            g.store = sweep_store(g.filename)
+            if (g.resume and g.store.reopen(g.assembler.freqs, g.offset)):
+                # the pyramid levels carry on from where they were
+                g.pyramid = waterfall_pyramid(g.store)
+                times = g.store.times()
+                if (len(times) > 0):
+                    g.store_after = float(times[-1])
+            else:
+                g.store.create(g.assembler.freqs, g.offset)
+                g.pyramid = waterfall_pyramid(g.store)
+                g.pyramid.reset()
+        if (g.store_after is not None):
+            # sweeps after the checkpoint that the store already has
+            sweeps = [s for s in sweeps if (s[0] > g.store_after)]
+        g.store.append(sweeps)
+        g.pyramid.update()
+        
+    except Exception as e:
+        
+        print("\nException occurred in update_store")
+        print(e)
+
+
+"""############################################################################
+
+    function:   save_outputs 
+
+    Writes the waterfall png, and in headless mode also the plot (spectrum
+    and waterfall axes) as <filename>_plot.png at the --size resolution. 
+
+############################################################################"""
+
+def save_outputs():
+    
+    save_waterfall_png()
+    
+    try:
+        
+        if (g.headless and (g.fig is not None)):
+            fstr = ("{}_plot.png" .format(g.filename))
+            g.fig.savefig(fstr, dpi=g.fig.dpi, facecolor='#FFFFFF')
+            print("Saved plot image to {}" .format(fstr))
+        g.last_save = g.sweep_count
+        
+    except Exception as e:
+        
+        print("\nException occurred in save_outputs")
+        print(e)
+
+
+"""############################################################################
+
+    function:   save_checkpoint / load_checkpoint / resume_capture 
+
+    With --resume, the derived state of the capture is saved to 
+    <name>.ckpt.npz every checkpoint_s seconds (by the pipeline worker) 
+    and when the capture ends: the waterfall rows the buffer holds, the 
+    spectrum accumulators, the color scale histogram, the detector noise 
+    floor, the sweep count toward -s N, and the time of the last sweep. It
+    is written to a temporary file and renamed, so an interruption while 
+    saving leaves the previous checkpoint intact. 
+    
+    When the capture is started again with --resume, the checkpoint is 
+    loaded, the csv file is binary searched (on the line timestamps) for 
+    the checkpointed sweep, and only the lines from there on are parsed. 
+    rtl_power then appends to the same csv file. The startup work depends 
+    on the time since the last checkpoint and the size of the waterfall, 
+    not on the length of the capture. A sweep that was only partly written
+    when the capture stopped is dropped. 
+
+############################################################################"""
+
+checkpoint_s = 60.0
+
+def save_checkpoint():
+    
+    if ((not g.resume) or (g.spectrum is None) or (g.wf is None) or (g.scale is None)):
+        return
+    
+    try:
+        
+        start = time.time()
+        sp = g.spectrum
+        state = {
+            "freqs": g.assembler.freqs,
+            "sweep_count": g.sweep_count,
+            "last_time": g.last_time,
+            "wf_db": g.wf.db_view(),
+            "wf_times": g.wf.times_view(),
+            "sp_count": sp.count,
+            "sp_sum": sp.sum,
+            "sp_counts": sp.counts,
+            "sp_max": sp.max,
+            "sp_min": sp.min,
+            "sp_ema": sp.ema,
+            "scale_hist": g.scale.hist,
+        }
+        if (g.detector is not None):
+            state["det_floor"] = g.detector.floor
+        
+        path = ("{}.ckpt.npz" .format(g.filename))
+        with open(path + ".part", "wb") as f:
+            np.savez(f, **state)
+        os.replace(path + ".part", path)
+        g.last_checkpoint = time.time()
+        print("Saved checkpoint of {} sweeps in {:0.0f} ms" .format(g.sweep_count, 
+            (g.last_checkpoint - start) * 1000.0))
+        
+    except Exception as e:
+        
+        print("\nException occurred in save_checkpoint")
+        print(e)
+
+
+def load_checkpoint():
+    
+    path = ("{}.ckpt.npz" .format(g.filename))
+    if (not os.path.isfile(path)):
+        print("No checkpoint ({}), starting a new capture" .format(path))
+        return False
+    
+    start = time.time()
+    with np.load(path) as z:
+        g.checkpoint = {k: z[k] for k in z.files}
+    g.last_time = float(g.checkpoint["last_time"])
+    print("Loaded checkpoint of {} sweeps in {:0.0f} ms" .format(
+        int(g.checkpoint["sweep_count"]), (time.time() - start) * 1000.0))
+    return True
+
+
+def csv_find_time(path, t):
+    
+    # returns the offset of a line start at or before the first line with
+    # a timestamp of t or later (rtl_power writes the lines in time order)
+    lo, hi = 0, os.path.getsize(path)
+    with open(path, "rb") as f:
+        while ((hi - lo) > 65536):
+            mid = (lo + hi) // 2
+            f.seek(mid)
+            f.readline()
+            hop = parse_csv_line(f.readline().decode("ascii", "replace"))
+            if ((hop is None) or (hop[0] >= t)):
+                hi = mid
+            else:
+                lo = mid
+        if (lo > 0):
+            f.seek(lo)
+            f.readline()
+            lo = f.tell()
+    return lo
+
+
+def csv_trim_partial(path):
+    
+    # cuts off a partly written last line, so that appended lines start 
+    # on a line of their own
+    size = os.path.getsize(path)
+    with open(path, "rb+") as f:
+        f.seek(max(size - 65536, 0))
+        tail = f.read()
+        end = tail.rfind(b"\n") + 1
+        if (end < len(tail)):
+            f.truncate(size - len(tail) + end)
+            print("Removed a partly written line from the end of {}" .format(path))
+
+
+def resume_capture():
+    
+    if ((not load_checkpoint()) or (not os.path.isfile(g.csv_path))):
+        return
+    
+    start = time.time()
+    csv_trim_partial(g.csv_path)
+    offset = csv_find_time(g.csv_path, g.last_time)
+    hops = [hop for hop in csv_tail_reader(g.csv_path, offset).read_hops() 
+        if (hop[0] >= g.last_time)]
+    sweeps = g.assembler.add_hops(hops)
+    if (g.assembler.freqs is None):
+        # only the checkpointed sweep is here, and it is complete
+        sweeps += g.assembler.flush()
+    else:
+        # the last sweep may be incomplete, and rtl_power will not add to 
+        # it, so it is only kept when it has every hop of the layout
+        pending = sorted(g.assembler.pending, key=lambda hop: hop[1])
+        if ((len(pending) == g.assembler.hops) and ((g.assembler.layout is None) or 
+            ([(hop[1], len(hop[5])) for hop in pending] == g.assembler.layout))):
+            sweeps += g.assembler.flush()
+        else:
+            g.assembler.discard()
+    sweeps = [s for s in sweeps if (s[0] > g.last_time)]
+    print("Read {} sweeps after the checkpoint from the last {} bytes of {} in {:0.0f} ms" 
+        .format(len(sweeps), os.path.getsize(g.csv_path) - offset, g.csv_path, 
+        (time.time() - start) * 1000.0))
+    
+    if (g.assembler.freqs is not None):
+        g.pending_sweeps += sweeps
+        update_spectrum(sweeps)
+
+
+def apply_checkpoint():
+    
+    # called by update_spectrum when the frequency axis is first known
+    ck = g.checkpoint
+    if ((len(ck["freqs"]) != len(g.assembler.freqs)) or 
+        (not np.allclose(ck["freqs"], g.assembler.freqs))):
+        print("The checkpoint has a different frequency layout, so it is not used")
+        g.checkpoint = None
+        return
+    
+    sp = g.spectrum
+    sp.count = int(ck["sp_count"])
+    sp.sum[:] = ck["sp_sum"]
+    sp.counts[:] = ck["sp_counts"]
+    sp.max[:] = ck["sp_max"]
+    sp.min[:] = ck["sp_min"]
+    sp.ema[:] = ck["sp_ema"]
+    g.sweep_count = int(ck["sweep_count"])
+    g.y_vals = sp.trace("avg")
+
+
+def restore_waterfall():
+    
+    # called by initialize_plot once the waterfall buffer exists, before 
+    # the sweeps that came after the checkpoint are added
+    ck = g.checkpoint
+    if (ck is None):
+        return
+    
+    if (g.palette is None):
+        g.palette = build_palette(g.palette_name, g.rgbxy)
+    g.scale = color_scale(g.palette)
+    g.scale.hist[:] = ck["scale_hist"]
+    g.scale.update()
+    g.db_min, g.db_max = g.scale.db_min, g.scale.db_max
+    
+    rows = ck["wf_db"][-g.wf.rows:]
+    times = ck["wf_times"][-g.wf.rows:] if ("wf_times" in ck) else np.zeros(len(rows))
+    if (len(rows) > 0):
+        g.wf.append(times, rows, g.wf_dec.peak(g.scale.levels(rows)))
+        g.wf.recolor(g.scale.lut)
+    print("Restored {} waterfall rows from the checkpoint" .format(len(rows)))
+
+
+"""############################################################################
+
+    function:   allocate_waterfall 
+
+    Sizes the waterfall buffer once, from the waterfall axes size (or from
+    the -a N height) and the -s stop value. 
+
+############################################################################"""
+
+def allocate_waterfall(bins):
+    
+    if (g.aspect > 1):
+        # -a N forces the waterfall to N pixels (sweeps) high
+        g.wf_pad = g.aspect
+    else:
+        # the number of sweeps that fill the window at the window aspect ratio
+        g.wf_pad = max(int(float(g.ax2_h) * bins / float(g.ax2_w)), 1)
+    
+    rows = g.wf_pad
+    if (g.stop > 1):
+        rows = max(rows, g.stop)
+    
+    g.wf_dec = bin_decimator(bins)
+    g.wf_dec.plan(0, bins, g.ax2_w)
+    g.wf = waterfall_buffer(rows, bins, (0 == g.stop), g.wf_dec)
+    print("Waterfall buffer: {} sweeps of {} bins" .format(rows, bins))
+
+
+"""############################################################################
+
+    function:   update_waterfall 
+
+############################################################################"""
+    
+def update_waterfall():
+    
+    print("Updating waterfall")
+    
+    try:
+        
+        h1,w1 = g.wf.filled(), g.wf.bins
+        print("image size: width={}, height={}" .format(w1,h1))
+        #print("ax2 window size: width={}, height={}" .format(g.ax2_w, g.ax2_h))
+        
+        
+        '''
+        self.stop = 0       # 0 = autostop disabled
+                            # 1 = autostop when window filled
+                            # N = autostop when N sweeps completed
+        self.aspect = 0     # 0 = stretch/shrink window to fill display
+                            # 1 = force image aspect ratio to window
+                            # N = force waterfall to N pixel height
+        '''
+        
+        
+        # if g.stop == 0 (disabled)
+        if (0 == g.stop):
+            pass # do nothing
+    
+        # if g.stop == 1 (stop when window filled)
+        elif (1 == g.stop):
+            print("auto-stopping in {} sweeps" .format(g.wf_pad-h1))
+            # and the window is full
+            if (h1 >= g.wf_pad):
+                g.done = True  
+        
+        # if g.stop == N (stop after N sweeps)
+        else:
+            print("auto-stopping in {} sweeps" .format(g.stop-g.sweep_count))
+            if (g.sweep_count >= g.stop):
+                g.done = True
+            
+
+        if (0 == g.aspect):
+            # the image stretches, so only show the rows written so far
+            g.combined_image = g.wf.view(h1)
+        else:
+            # pad with black (unwritten) rows up to the window height
+            g.combined_image = g.wf.view(max(h1, g.wf_pad))
+        g.tmax = g.combined_image.shape[0]
+
+        #print("done")
+        
+    except Exception as e:
+        
+        print("\nException occurred in update_waterfall")
+        print(e)
+    
+
+"""############################################################################
+
+    class:      spectrum_accumulator 
+
+    Keeps the spectrum traces as running numpy accumulators that are updated
+    with each new sweep: a running sum and count for the average, element-
+    wise max and min for the hold traces, and an exponential moving average.
+    The cost of each update depends only on the number of bins. Missing 
+    (nan) bins are skipped rather than spoiling the traces. 
+
+############################################################################"""
+
+trace_names = ["avg", "max", "min", "ema"]
+trace_colors = {"max": "#FF4040", "min": "#40A0FF", "ema": "#FFFFFF"}
+
+class spectrum_accumulator:
+    
+    def __init__(self, bins, ema_alpha=0.1):
+        
+        self.bins = bins
+        self.alpha = ema_alpha
+        self.count = 0
+        self.sum = np.zeros(bins, dtype=np.float64)
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.max = np.full(bins, np.nan, dtype=np.float32)
+        self.min = np.full(bins, np.nan, dtype=np.float32)
+        self.ema = np.full(bins, np.nan, dtype=np.float32)
+        
+    def add(self, db_rows):
+        
+        valid = ~np.isnan(db_rows)
+        self.sum += np.where(valid, db_rows, 0.0).sum(axis=0)
+        self.counts += valid.sum(axis=0)
+        self.count += len(db_rows)
+        
+        # fmax/fmin ignore nan, so the first value of each bin is taken as is
+        self.max = np.fmax(self.max, np.fmax.reduce(db_rows, axis=0))
+        self.min = np.fmin(self.min, np.fmin.reduce(db_rows, axis=0))
+        
+        for db_row in db_rows:
+            first = np.isnan(self.ema)
+            self.ema[first] = db_row[first]
+            step = self.alpha * (db_row - self.ema)
+            self.ema += np.nan_to_num(step, nan=0.0)
+        
+    def trace(self, name):
+        
+        if (name == "max"):
+            return self.max
+        if (name == "min"):
+            return self.min
+        if (name == "ema"):
+            return self.ema
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum / self.counts
+
+
+"""############################################################################
+
+    function:   update_spectrum 
+
+############################################################################"""
+
+def update_spectrum(sweeps):
+    
+    print("Updating spectrum")
+    
+    try:
+        
+        if (g.spectrum is None):
+            g.spectrum = spectrum_accumulator(len(g.assembler.freqs), g.ema_alpha)
+            # the frequency axis never changes, so the offset and MHz 
+            # scaling are applied to it once. 
+            g.x_vals = (g.assembler.freqs + g.offset) / 1000000.0
+            if (g.checkpoint is not None):
+                apply_checkpoint()
+        
+        if (len(sweeps) > 0):
+            g.spectrum.add(np.array([db_row for timestamp, db_row in sweeps], 
+                dtype=np.float32))
+            g.y_vals = g.spectrum.trace("avg")
+
+        #print("size of y_vals[] = {}" .format(len(g.y_vals)))
+        
+    except Exception as e:
+        
+        print("\nException occurred in update_spectrum")
+        print(e)
+        
+
+"""############################################################################
+
+    class:      activity_detector 
+
+    Finds signals in each new sweep as it arrives, for catching intermittent
+    transmitters without watching the waterfall. Each bin has a noise floor
+    estimate that tracks its quiet level (it falls quickly and rises slowly,
+    and is not updated while the bin is hot). A bin turns hot when it is 
+    'threshold' dB above its floor, and only turns cold again when it drops
+    below threshold - detect_hysteresis_db. Adjacent hot bins are grouped 
+    into signals, which are matched to the signals of the previous sweep by
+    overlap. Each onset and offset is appended to <name>_events.jsonl as a
+    json line with the time, the frequency (with the -o offset), the 
+    bandwidth and the peak power. The per-sweep work is a few numpy passes
+    over the bins plus a loop over the signals. 
+
+############################################################################"""
+
+detect_hysteresis_db = 3.0
+detect_rise = 0.05      # noise floor ema factors, for values above and
+detect_fall = 0.5       # below the current floor
+
+class activity_detector:
+    
+    def __init__(self, freqs, offset, threshold, path):
+        
+        self.freqs = np.asarray(freqs, dtype=np.float64) + offset
+        self.step = float(self.freqs[1] - self.freqs[0]) if (len(self.freqs) > 1) else 0.0
+        self.threshold = threshold
+        self.floor = np.full(len(freqs), np.nan, dtype=np.float32)
+        self.hot = np.zeros(len(freqs), dtype=bool)
+        self.active = []            # signals that are on, oldest first
+        self.last_time = None
+        self.events = 0
+        self.sink = csv_sink(path, "a")
+        
+    def add(self, timestamp, db_row):
+        
+        valid = ~np.isnan(db_row)
+        first = valid & np.isnan(self.floor)
+        self.floor[first] = db_row[first]
+        
+        level = db_row - self.floor
+        with np.errstate(invalid='ignore'):
+            on = level > self.threshold
+            stay = level > (self.threshold - detect_hysteresis_db)
+        self.hot = np.where(self.hot, stay, on) & valid & ~first
+        
+        quiet = valid & ~self.hot
+        rate = np.where(level[quiet] > 0, detect_rise, detect_fall)
+        self.floor[quiet] += rate * level[quiet]
+        
+        self.match(timestamp, db_row, self.runs())
+        self.last_time = timestamp
+        
+    def runs(self):
+        
+        # (start, stop) bin ranges of the adjacent hot bins
+        edges = np.diff(np.concatenate(([0], self.hot.view(np.int8), [0])))
+        return list(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+        
+    def match(self, timestamp, db_row, runs):
+        
+        # both lists are in frequency order, so they are walked together. A
+        # run that overlaps an active signal continues it, a run that does
+        # not is an onset, and a signal that no run overlaps is an offset. 
+        active = sorted(self.active, key=lambda sig: sig["lo"])
+        self.active = []
+        k = 0
+        for start, stop in runs:
+            peak_bin = start + int(np.argmax(db_row[start:stop]))
+            while ((k < len(active)) and (active[k]["hi"] <= start)):
+                self.offset(active[k], timestamp)
+                k += 1
+            if ((k < len(active)) and (active[k]["lo"] < stop)):
+                sig = active[k]
+                k += 1
+                # a run that bridges several signals merges them into the
+                # first one, and the others end here
+                while ((k < len(active)) and (active[k]["lo"] < stop)):
+                    self.offset(active[k], timestamp)
+                    k += 1
+            else:
+                sig = {"start": timestamp, "peak_db": -np.inf, "min_bin": start, 
+                    "max_bin": stop}
+                self.event("onset", timestamp, sig, start, stop, peak_bin, db_row[peak_bin])
+            sig["lo"], sig["hi"] = start, stop
+            sig["min_bin"] = min(sig["min_bin"], start)
+            sig["max_bin"] = max(sig["max_bin"], stop)
+            if (db_row[peak_bin] > sig["peak_db"]):
+                sig["peak_db"], sig["peak_bin"] = float(db_row[peak_bin]), peak_bin
+            self.active.append(sig)
+        for sig in active[k:]:
+            self.offset(sig, timestamp)
+        
+    def offset(self, sig, timestamp):
+        
+        self.event("offset", timestamp, sig, sig["min_bin"], sig["max_bin"], 
+            sig["peak_bin"], sig["peak_db"])
+        
+    def event(self, kind, timestamp, sig, lo, hi, peak_bin, peak_db):
+        
+        rec = {
+            "event": kind,
+            "time": datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S"),
+            "timestamp": timestamp,
+            "freq_hz": round(float(self.freqs[lo] + self.freqs[hi-1]) / 2.0, 1),
+            "bandwidth_hz": round((hi - lo) * self.step, 1),
+            "peak_freq_hz": round(float(self.freqs[peak_bin]), 1),
+            "peak_db": round(float(peak_db), 2),
+        }
+        if (kind == "offset"):
+            rec["duration_s"] = round(timestamp - sig["start"], 3)
+        self.sink.write(json.dumps(rec) + "\n")
+        self.events += 1
+        print("Signal {} at {:0.4f} MHz, {:0.1f} kHz wide, {:0.1f} dB" .format(kind, 
+            rec["freq_hz"] / 1e6, rec["bandwidth_hz"] / 1e3, rec["peak_db"]))
+        
+    def close(self):
+        
+        # the signals that are still on end with the capture
+        for sig in self.active:
+            self.offset(sig, self.last_time)
+        self.active = []
+        self.sink.close()
+
+
+"""############################################################################
+
+    function:   update_detector 
+
+############################################################################"""
+
+def update_detector(sweeps):
+    
+    if (g.detect_db <= 0):
+        return
+    
+    try:
+        
+        if (g.detector is None):
+            path = ("{}_events.jsonl" .format(g.filename))
+            g.detector = activity_detector(g.assembler.freqs, g.offset, g.detect_db, path)
+            if ((g.checkpoint is not None) and ("det_floor" in g.checkpoint)):
+                g.detector.floor[:] = g.checkpoint["det_floor"]
+            print("Writing signal events to {}" .format(path))
+        for timestamp, db_row in sweeps:
+            g.detector.add(timestamp, db_row)
+        
+    except Exception as e:
+        
+        print("\nException occurred in update_detector")
+        print(e)
+
+
+"""############################################################################
+
+    class:      live_server 
+
+    A small built-in web viewer for watching a capture from another machine
+    (--serve), using only the standard library. It serves one page at / and
+    a WebSocket at /ws, from an asyncio loop on a background thread. 
+    
+    Each new batch of sweeps is encoded once, by the pipeline worker, into 
+    binary messages that are sent unchanged to every viewer: the new 
+    waterfall rows as uint8 palette indices (peak-decimated to serve_cols 
+    columns, 0 = no data), and the average trace quantized to uint8. Each 
+    message is zlib compressed when that makes it smaller. The bandwidth 
+    follows the sweep rate, not the window size, and adding viewers adds no
+    encoding work. A new viewer is sent the layout (a json text message), 
+    the last serve_backlog rows and the latest trace. A viewer that falls 
+    more than serve_queue messages behind is disconnected. 
+    
+        rows:       <BBHHIff  type 1, flags, rows, cols, first row, db_min,
+                    db_max, then rows x cols indices
+        spectrum:   <BBHff    type 2, flags, cols, y_min, y_max, then cols 
+                    values (0-254 from y_min to y_max, 255 = no data)
+        
+    flags bit 0 means the part after the header is zlib compressed. 
+
+############################################################################"""
+
+serve_cols = 1024       # columns sent to the viewers
+serve_backlog = 512     # waterfall rows a new viewer starts with
+serve_queue = 256       # messages a viewer may fall behind
+ws_guid = "258EAFA5-E914-47DA-95CA-C5AB0DC11B85"
+
+class live_server:
+    
+    def __init__(self, host, port):
+        
+        self.host = host
+        self.port = port
+        self.clients = set()
+        self.hello = None           # ws frame with the layout
+        self.backlog = collections.deque()  # ws frames of the last rows
+        self.backlog_rows = 0
+        self.spectrum = None        # ws frame with the latest trace
+        self.row_seq = 0
+        self.decimator = None
+        self.palette = None
+        self.bytes_sent = 0
+        
+        self.error = None
+        
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(started,), daemon=True)
+        self.thread.start()
+        started.wait(5.0)
+        if (self.error is not None):
+            # e.g. the port is in use. Nothing would ever run the loop.
+            self.loop.close()
+            raise self.error
+        
+    def run(self, started):
+        
+        try:
+            self.server = self.loop.run_until_complete(asyncio.start_server(self.handle, 
+                self.host, self.port))
+            self.port = self.server.sockets[0].getsockname()[1]
+            print("Serving the live viewer at http://{}:{}/" .format(self.host, self.port))
+        except Exception as e:
+            self.error = e
+            started.set()
+            return
+        # ready once the loop is actually running, so that nothing is 
+        # published into the gap before run_forever
+        self.loop.call_soon(started.set)
+        self.loop.run_forever()
+        
+    def stop(self):
+        
+        if (self.loop.is_running()):
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(5.0)
+    
+    # ---- encoding, on the pipeline worker thread ---------------------------
+        
+    def set_layout(self, freqs, offset, palette, title):
+        
+        bins = len(freqs)
+        self.decimator = bin_decimator(bins)
+        self.decimator.plan(0, bins, serve_cols)
+        # index 0 is kept for missing bins, so the palette is resampled to 255
+        pick = np.linspace(0, len(palette) - 1, 255).round().astype(np.intp)
+        self.palette = np.vstack(([0, 0, 0], palette[pick])).astype(np.uint8)
+        mhz = (np.asarray(freqs, dtype=np.float64) + offset) / 1000000.0
+        hello = {"bins": bins, "cols": self.decimator.cols, "rows": serve_backlog, 
+            "f_lo": float(mhz[0]), "f_hi": float(mhz[-1]), "title": title, 
+            "palette": self.palette.tobytes().hex()}
+        self.publish(ws_frame(json.dumps(hello).encode(), 0x1), "hello")
+        
+    def add_rows(self, db_rows, db_min, db_max):
+        
+        rows = self.decimator.peak(db_rows)
+        span = max(db_max - db_min, 1e-6)
+        tone = np.nan_to_num((rows - db_min) * (254.0 / span), nan=-1.0)
+        idx = (np.clip(tone, 0, 254) + 1).astype(np.uint8)
+        idx[np.isnan(rows)] = 0
+        header = struct.pack("<BBHHIff", 1, 0, len(idx), idx.shape[1], self.row_seq, 
+            db_min, db_max)
+        self.row_seq += len(idx)
+        self.publish(ws_frame(pack_payload(header, idx.tobytes())), "rows", len(idx))
+        
+    def set_spectrum(self, trace):
+        
+        values = self.decimator.peak(trace)
+        valid = ~np.isnan(values)
+        if (not np.any(valid)):
+            return
+        y_min, y_max = float(np.min(values[valid])), float(np.max(values[valid]))
+        span = max(y_max - y_min, 1e-6)
+        q = np.full(len(values), 255, dtype=np.uint8)
+        q[valid] = np.clip(np.rint((values[valid] - y_min) * (254.0 / span)), 0, 254)
+        header = struct.pack("<BBHff", 2, 0, len(q), y_min, y_max)
+        self.publish(ws_frame(pack_payload(header, q.tobytes())), "spectrum")
+        
+    def publish(self, frame, kind, rows=0):
+        
+        # nothing would ever take the frames off a loop that failed to 
+        # start (frames sent before it runs are taken when it does)
+        if (self.error is None):
+            self.loop.call_soon_threadsafe(self.broadcast, frame, kind, rows)
+    
+    # ---- the asyncio loop --------------------------------------------------
+        
+    def broadcast(self, frame, kind, rows):
+        
+        if (kind == "hello"):
+            self.hello = frame
+            self.backlog.clear()
+            self.backlog_rows = 0
+        elif (kind == "rows"):
+            self.backlog.append((frame, rows))
+            self.backlog_rows += rows
+            while ((self.backlog_rows - self.backlog[0][1]) >= serve_backlog):
+                self.backlog_rows -= self.backlog.popleft()[1]
+        else:
+            self.spectrum = frame
+        
+        for q, writer in list(self.clients):
+            try:
+                q.put_nowait(frame)
+            except asyncio.QueueFull:
+                print("Dropped a live viewer that fell behind")
+                self.clients.discard((q, writer))
+                writer.close()
+        
+    async def handle(self, reader, writer):
+        
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            lines = request.decode("latin-1").split("\r\n")
+            path = lines[0].split(" ")[1]
+            headers = {}
+            for line in lines[1:]:
+                if (":" in line):
+                    key, value = line.split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+            
+            if ((path == "/ws") and (headers.get("upgrade", "").lower() == "websocket")):
+                await self.serve_ws(reader, writer, headers)
+            elif (path in ("/", "/index.html")):
+                body = viewer_html.encode()
+                writer.write(("HTTP/1.1 200 OK\r\nContent-Type: text/html; charset=utf-8\r\n"
+                    "Content-Length: {}\r\nConnection: close\r\n\r\n" .format(len(body))).encode() + body)
+                await writer.drain()
+            else:
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        except Exception as e:
+            print("\nException occurred in live_server.handle")
+            print(e)
+        finally:
+            writer.close()
+        
+    async def serve_ws(self, reader, writer, headers):
+        
+        accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + ws_guid)
+            .encode()).digest()).decode()
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
+            "Connection: Upgrade\r\nSec-WebSocket-Accept: {}\r\n\r\n" .format(accept)).encode())
+        
+        # the current state, then every new message (nothing can be 
+        # broadcast in between, since this runs on the loop)
+        if (self.hello is not None):
+            writer.write(self.hello)
+        for frame, rows in self.backlog:
+            writer.write(frame)
+        if (self.spectrum is not None):
+            writer.write(self.spectrum)
+        q = asyncio.Queue(maxsize=serve_queue)
+        client = (q, writer)
+        self.clients.add(client)
+        print("Live viewer connected ({} viewers)" .format(len(self.clients)))
+        
+        sender = asyncio.ensure_future(self.send_loop(q, writer))
+        try:
+            await self.read_loop(reader, writer)
+        finally:
+            self.clients.discard(client)
+            sender.cancel()
+            print("Live viewer disconnected ({} viewers)" .format(len(self.clients)))
+        
+    async def send_loop(self, q, writer):
+        
+        try:
+            await writer.drain()
+            while (True):
+                frame = await q.get()
+                writer.write(frame)
+                self.bytes_sent += len(frame)
+                await writer.drain()
+        except ConnectionError:
+            writer.close()
+        
+    async def read_loop(self, reader, writer):
+        
+        # viewers send nothing but pings and the close handshake
+        while (True):
+            head = await reader.readexactly(2)
+            opcode = head[0] & 0x0F
+            length = head[1] & 0x7F
+            if (length == 126):
+                length = struct.unpack(">H", await reader.readexactly(2))[0]
+            elif (length == 127):
+                length = struct.unpack(">Q", await reader.readexactly(8))[0]
+            mask = (await reader.readexactly(4)) if (head[1] & 0x80) else bytes(4)
+            data = bytearray(await reader.readexactly(length))
+            for k in range(len(data)):
+                data[k] ^= mask[k % 4]
+            if (opcode == 0x8):
+                writer.write(ws_frame(bytes(data[:2]), 0x8))
+                break
+            if (opcode == 0x9):
+                writer.write(ws_frame(bytes(data), 0xA))
+
+
+def ws_frame(payload, opcode=0x2):
+    
+    # a single unmasked (server to client) frame
+    n = len(payload)
+    if (n < 126):
+        head = struct.pack(">BB", 0x80 | opcode, n)
+    elif (n < 65536):
+        head = struct.pack(">BBH", 0x80 | opcode, 126, n)
+    else:
+        head = struct.pack(">BBQ", 0x80 | opcode, 127, n)
+    return head + payload
+
+
+def pack_payload(header, body):
+    
+    packed = zlib.compress(body, 6)
+    if (len(packed) < len(body)):
+        # set the compressed flag
+        return header[:1] + b"\x01" + header[2:] + packed
+    return header + body
+
+
+viewer_html = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>RTL_SpectrumSweeper</title>
+<style>
+body { margin: 0; background: #000; color: #ccc; font: 12px sans-serif; }
+canvas { display: block; width: 100%; image-rendering: pixelated; }
+#info { padding: 2px 6px; }
+</style></head>
+<body>
+<div id="info">connecting...</div>
+<canvas id="spec" height="200"></canvas>
+<canvas id="wf"></canvas>
+<script>
+const info = document.getElementById("info");
+const spec = document.getElementById("spec"), sctx = spec.getContext("2d");
+const wf = document.getElementById("wf"), wctx = wf.getContext("2d");
+let hello = null, pal = null, chain = Promise.resolve();
+
+async function inflate(bytes) {
+    const s = new Blob([bytes]).stream().pipeThrough(new DecompressionStream("deflate"));
+    return new Uint8Array(await new Response(s).arrayBuffer());
+}
+
+async function body(buf, offset) {
+    const data = new Uint8Array(buf, offset);
+    return (new DataView(buf).getUint8(1) & 1) ? inflate(data) : data;
+}
+
+function setup(h) {
+    hello = h;
+    pal = new Uint8Array(h.palette.match(/../g).map(x => parseInt(x, 16)));
+    spec.width = wf.width = h.cols;
+    wf.height = h.rows;
+    wctx.fillStyle = "#000"; wctx.fillRect(0, 0, wf.width, wf.height);
+    info.textContent = h.title + "   " + h.f_lo.toFixed(3) + " - " + h.f_hi.toFixed(3) + " MHz";
+}
+
+function drawRows(n, cols, idx) {
+    // newest row at the bottom, older rows scroll up
+    n = Math.min(n, wf.height);
+    idx = idx.subarray(idx.length - n * cols);
+    wctx.drawImage(wf, 0, -n);
+    const img = wctx.createImageData(cols, n);
+    for (let k = 0; k < idx.length; k++) {
+        const p = idx[k] * 3;
+        img.data[k*4] = pal[p]; img.data[k*4+1] = pal[p+1]; img.data[k*4+2] = pal[p+2];
+        img.data[k*4+3] = 255;
+    }
+    wctx.putImageData(img, 0, wf.height - n);
+}
+
+function drawSpectrum(y_min, y_max, q) {
+    sctx.fillStyle = "#000"; sctx.fillRect(0, 0, spec.width, spec.height);
+    sctx.strokeStyle = "#FF0"; sctx.beginPath();
+    let pen = false;
+    for (let x = 0; x < q.length; x++) {
+        if (q[x] == 255) { pen = false; continue; }
+        const y = spec.height - 1 - q[x] * (spec.height - 1) / 254;
+        if (pen) sctx.lineTo(x, y); else sctx.moveTo(x, y);
+        pen = true;
+    }
+    sctx.stroke();
+    sctx.fillStyle = "#ccc";
+    sctx.fillText(y_max.toFixed(1) + " dB", 4, 12);
+    sctx.fillText(y_min.toFixed(1) + " dB", 4, spec.height - 4);
+}
+
+async function handle(buf) {
+    const dv = new DataView(buf);
+    if (dv.getUint8(0) == 1) {
+        drawRows(dv.getUint16(2, true), dv.getUint16(4, true), await body(buf, 18));
+    } else if (dv.getUint8(0) == 2) {
+        drawSpectrum(dv.getFloat32(4, true), dv.getFloat32(8, true), await body(buf, 12));
+    }
+}
+
+const ws = new WebSocket((location.protocol == "https:" ? "wss://" : "ws://") + location.host + "/ws");
+ws.binaryType = "arraybuffer";
+ws.onmessage = (ev) => {
+    if (typeof ev.data === "string") { setup(JSON.parse(ev.data)); return; }
+    // messages are handled in order, even though inflating is async
+    chain = chain.then(() => hello && handle(ev.data));
+};
+ws.onclose = () => { info.textContent += "   (disconnected)"; };
+</script>
+</body></html>
+"""
+
+
+"""############################################################################
+
+    function:   start_live_server / update_server 
+
+    Hands each new batch of sweeps to the live viewer server (--serve). 
+    Called by the pipeline worker after the spectrum has been updated. 
+
+############################################################################"""
+
+def start_live_server():
+    
     try:
-        cmd_str = ("python heatmap.py --nolabels{} {}.csv {}.png" .format(g.hmp_str, g.filename, g.filename)) 
-        cmd = cmd_str.split()
-        #print(cmd)
+        g.server = live_server(g.serve_host, g.serve_port)
+    except Exception as e:
+        # the capture carries on without the viewer
+        print("\nCould not serve the live viewer on {}:{}: {}" .format(g.serve_host, 
+            g.serve_port, e))
+        g.server = None
+
 
-        proc = subprocess.Popen(cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True)
+def update_server(sweeps):
+    
+    if ((g.server is None) or (len(sweeps) == 0)):
+        return
+    
+    try:
         
-        while(True):
-            rspn = (str(proc.stdout.readline())).rstrip()
-            if (rspn == ""):
-                #print("done")
-                break
-            else:
-                #print(rspn)
-                pass
+        if (g.server.decimator is None):
+            g.server.set_layout(g.assembler.freqs, g.offset, g.palette, g.fig_title)
+        g.server.add_rows(np.array([db_row for timestamp, db_row in sweeps], 
+            dtype=np.float32), g.db_min, g.db_max)
+        g.server.set_spectrum(g.spectrum.trace("avg"))
         
     except Exception as e:
         
-        print("\nException occurred in update_csv_data")
+        print("\nException occurred in update_server")
         print(e)
 
-    finally:
+
+"""############################################################################
+
+    class:      sweep_shm 
+
+    Publishes the assembled sweeps in a shared memory ring buffer (--shm),
+    so that other programs on the same machine can read them as numpy 
+    arrays without parsing the csv file again. The block is laid out as:
+    
+        header      64 bytes, <8sIIIIdddQ: b"RTLSWEEP", version, bins, 
+                    slots, flags (0), freq_start, freq_step, -o offset (Hz),
+                    seq (the number of sweeps published so far)
+        freqs       float64 x bins, the Hz of each bin (without -o)
+        slot_seq    uint64 x slots, the seq of the sweep in each slot
+        times       float64 x slots, the timestamp of each slot
+        rows        float32 x slots x bins, the dB values (nan = no data)
+    
+    Sweep n (counting from 1) is written to slot (n - 1) % slots. Its 
+    slot_seq is set to 0 before the slot is written and to n after it, and
+    the header seq is set to n last, so a reader that finds slot_seq == n 
+    both before and after using a slot has read a whole sweep. A reader 
+    that falls more than 'slots' sweeps behind finds its sweeps overwritten.
+    shm_consumer.py is a reference reader. 
+    
+    The block is removed when the capture ends. One left behind by a crash
+    is replaced at the next start. 
+
+############################################################################"""
+
+shm_magic = b"RTLSWEEP"
+shm_header = struct.Struct("<8sIIIIdddQ")   # padded to shm_header_size
+shm_header_size = 64
+shm_seq_offset = 48
+shm_slots = 256
+
+class sweep_shm:
+    
+    def __init__(self, name, freqs, offset, slots=shm_slots):
+        
+        # multiprocessing.shared_memory is Python 3.8 or later, so it is 
+        # only imported when --shm is given
+        from multiprocessing import shared_memory
+        
+        bins = len(freqs)
+        size = shm_header_size + 8 * bins + 16 * slots + 4 * slots * bins
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # left behind by a capture that did not end cleanly
+            old = shared_memory.SharedMemory(name)
+            old.close()
+            old.unlink()
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        
+        self.name = name
+        self.slots = slots
+        self.seq = 0
+        buf = self.shm.buf
+        step = float(np.median(np.diff(freqs))) if (bins > 1) else 0.0
+        shm_header.pack_into(buf, 0, shm_magic, 1, bins, slots, 0, float(freqs[0]), 
+            step, float(offset), 0)
+        
+        at = shm_header_size
+        self.freqs = np.ndarray((bins,), dtype=np.float64, buffer=buf, offset=at)
+        at += 8 * bins
+        self.slot_seq = np.ndarray((slots,), dtype=np.uint64, buffer=buf, offset=at)
+        at += 8 * slots
+        self.times = np.ndarray((slots,), dtype=np.float64, buffer=buf, offset=at)
+        at += 8 * slots
+        self.rows = np.ndarray((slots, bins), dtype=np.float32, buffer=buf, offset=at)
+        self.head = np.ndarray((1,), dtype=np.uint64, buffer=buf, offset=shm_seq_offset)
         
-        proc.terminate()
+        self.freqs[:] = freqs
+        self.slot_seq[:] = 0
+        print("Publishing sweeps to shared memory '{}' ({} slots of {} bins, {} bytes)" 
+            .format(name, slots, bins, size))
+        
+    def publish(self, sweeps):
+        
+        for timestamp, db_row in sweeps:
+            self.seq += 1
+            k = (self.seq - 1) % self.slots
+            self.slot_seq[k] = 0
+            self.times[k] = timestamp
+            self.rows[k] = db_row
+            self.slot_seq[k] = self.seq
+            self.head[0] = self.seq
+        
+    def close(self):
+        
+        # the numpy views must be gone before the block can be closed
+        self.freqs = self.slot_seq = self.times = self.rows = self.head = None
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
 
 
 """############################################################################
 
-    function:   update_waterfall 
+    function:   update_shm 
 
 ############################################################################"""
+
+def update_shm(sweeps):
     
-def update_waterfall():
-    
-    print("Updating waterfall")
+    if ((g.shm_name == "") or (len(sweeps) == 0)):
+        return
     
     try:
         
-        fstr = ("{}.png" .format(g.filename))
-        #print("opening: {}" .format(fstr))
-        img1 = Image.open(fstr)
-        #print("opened image file")
-        w1,h1 = img1.size
-        print("image size: width={}, height={}" .format(w1,h1))
-        #print("ax2 window size: width={}, height={}" .format(g.ax2_w, g.ax2_h))
+        if (g.shm is None):
+            g.shm = sweep_shm(g.shm_name, g.assembler.freqs, g.offset)
+        g.shm.publish(sweeps)
+        
+    except Exception as e:
+        
+        print("\nException occurred in update_shm")
+        print(e)
+        # (e.g. no shared memory on this Python) do not try again
+        g.shm_name = ""
+
+
+"""############################################################################
+
+    function:   split_csv / parse_csv_chunk 
+
+    For the offline replay, a csv file is split into byte ranges that start
+    and end on line boundaries, and the ranges are parsed by a process pool.
+    The hops come back in file order, so they can be assembled as usual. 
+
+############################################################################"""
+
+def split_csv(path, chunks):
+    
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, "rb") as f:
+        for k in range(1, chunks):
+            f.seek(max((size * k) // chunks, bounds[-1]))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(path, bounds[k], bounds[k+1]) for k in range(chunks) if (bounds[k] < bounds[k+1])]
+
+
+def parse_csv_chunk(chunk):
+    
+    path, start, stop = chunk
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(stop - start)
+    
+    hops = []
+    for line in data.split(b"\n"):
+        hop = parse_csv_line(line.decode("ascii", "replace"))
+        if (hop is not None):
+            hops.append(hop)
+    return hops
+
+
+"""############################################################################
+
+    function:   load_capture 
+
+    Loads a whole capture for replay. Returns (timestamps, rows, freqs). A 
+    binary sweep store is just memory-mapped. A csv file is parsed in 
+    parallel, in byte ranges, by a process pool (or in this process with 
+    procs=1, e.g. in a --batch pool process, which cannot have children). 
+
+############################################################################"""
+
+def load_capture(path, procs=0):
+    
+    # a csv file converted with --convert is stored next to it, as x.sweeps
+    base = path[:-len(".sweeps")] if path.endswith(".sweeps") else os.path.splitext(path)[0]
+    if (os.path.isfile(base + ".sweeps")):
+        store = sweep_store(base).open()
+        print("Memory-mapped {} sweeps from {}.sweeps" .format(store.count(), base))
+        return store.times(), store.rows(), store.freqs()
+    
+    if (procs <= 0):
+        procs = multiprocessing.cpu_count()
+    chunks = split_csv(path, procs * 4)
+    print("Parsing {} in {} chunks with {} processes" .format(path, len(chunks), procs))
+    
+    assembler = sweep_assembler(g.overlap)
+    sweeps = []
+    if (procs == 1):
+        for hops in map(parse_csv_chunk, chunks):
+            sweeps += assembler.add_hops(hops)
+    else:
+        with multiprocessing.Pool(processes=procs) as pool:
+            for hops in pool.imap(parse_csv_chunk, chunks):
+                sweeps += assembler.add_hops(hops)
+    sweeps += assembler.flush()
+    
+    times = np.array([t for t, db_row in sweeps], dtype=np.float64)
+    rows = np.array([db_row for t, db_row in sweeps], dtype=np.float32)
+    print("Parsed {} sweeps" .format(len(sweeps)))
+    return times, rows, assembler.freqs
+
+
+"""############################################################################
+
+    function:   render_replay 
+
+    Re-renders the full waterfall of an existing capture with the current
+    --palette/--rgbxy, and writes it to <name>_replay.png (scaled to --size
+    if it was given). The rows are colorized in blocks, so a memory-mapped 
+    capture is never loaded as floats all at once. 
+
+############################################################################"""
+
+def render_replay(path, procs=0):
+    
+    print("\nRendering replay of {}" .format(path))
+    start = time.time()
+    
+    times, rows, freqs = load_capture(path, procs)
+    if (len(rows) == 0):
+        print("No sweeps found")
+        return
+    
+    block = 4096
+    db_min = min([float(np.nanmin(rows[k:k+block])) for k in range(0, len(rows), block)])
+    db_max = max([float(np.nanmax(rows[k:k+block])) for k in range(0, len(rows), block)])
+    
+    palette = build_palette(g.palette_name, g.rgbxy)
+    rgb = np.empty((len(rows), rows.shape[1], 3), dtype=np.uint8)
+    for k in range(0, len(rows), block):
+        rgb[k:k+block] = colorize(np.asarray(rows[k:k+block]), palette, db_min, db_max)
+    
+    img = Image.fromarray(rgb)
+    if (g.size_set):
+        img = img.resize((g.out_size[0], g.out_size[1]), Image.LANCZOS)
+    
+    base = os.path.splitext(path)[0]
+    fstr = ("{}_replay.png" .format(base))
+    img.save(fstr)
+    g.sweep_count = len(rows)
+    print("Saved {} sweeps x {} bins to {} in {:0.1f} s" .format(len(rows), 
+        rows.shape[1], fstr, time.time() - start))
+
+
+"""############################################################################
+
+    class:      replay_source 
+
+    Replays a loaded capture into the live gui (or headless) at N times real
+    time. It stands in for both the rtl_power process (poll, terminate) and
+    the reader (read_hops, at_end), handing over each stored sweep as a 
+    single hop once its time has come. 
+
+############################################################################"""
+
+class replay_source:
+    
+    def __init__(self, times, rows, freqs, speed, watcher):
         
-        wpcnt = (g.ax2_w / float(w1))   
-        h2size = int((float(g.ax2_h)/float(wpcnt))-h1)
+        self.times = times
+        self.rows = rows
+        self.freqs = freqs
+        self.speed = speed
+        self.watcher = watcher
+        self.next = 0
+        self.t0_wall = time.time()
         
-        #print("wpcnt={}, h2size={}" .format(wpcnt, h2size))
-        #print("Remaining window size = {}" .format(h2size))
+    def read_hops(self):
         
+        elapsed = (time.time() - self.t0_wall) * self.speed
+        stop = int(np.searchsorted(self.times, self.times[0] + elapsed, side="right"))
         
-        '''
-        self.stop = 0       # 0 = autostop disabled
-                            # 1 = autostop when window filled
-                            # N = autostop when N sweeps completed
-        self.aspect = 0     # 0 = stretch/shrink window to fill display
-                            # 1 = force image aspect ratio to window
-                            # N = force waterfall to N pixel height
-        '''
+        hops = []
+        for k in range(self.next, stop):
+            hops.append((self.times[k], self.freqs[0], self.freqs[-1], 0.0, 0, 
+                np.asarray(self.rows[k])))
+        self.next = stop
         
+        # the pipeline reader checks again after the watcher interval, 
+        # which follows the replayed sweep period
+        return hops
         
-        # if g.stop == 0 (disabled)
-        if (0 == g.stop):
-            pass # do nothing
-    
-        # if g.stop == 1 (stop when window filled)
-        elif (1 == g.stop):
-            print("auto-stopping in {} sweeps" .format(h2size))
-            # and the window is full
-            if (h2size <= 0):
-                g.done = True  
+    def at_end(self):
         
-        # if g.stop == N (stop after N sweeps)
-        else:
-            # and the waterfal is more than N pixels high
-            print("auto-stopping in {} sweeps" .format(g.stop-h1))
-            if (h1 >= g.stop):
-                g.done = True
-            
-
-        if (0 == g.aspect):
-            #print("using unmodified heatmap image")
-            g.combined_image = img1
-            g.tmax = h1
-                
-        elif ((1 == g.aspect) and (h2size > 0)):
-            bg2 = Image.new("RGB",(w1,h2size),'#000000') 
-            w,h = bg2.size
-            #print("bgnd2 image size: width={}, height={}" .format(w,h))
-            g.combined_image = np.concatenate((img1, bg2), axis = 0)
-            w,h = g.combined_image.shape[1], g.combined_image.shape[0]
-            #print("combined image size: width={}, height={}" .format(w,h))
-            g.tmax = h 
+        return (self.next >= len(self.times))
         
-        else:
-            if ((g.aspect-h1) > 0):
-                bg2 = Image.new("RGB",(w1,g.aspect-h1),'#000000') 
-                w,h = bg2.size
-                #print("bgnd2 image size: width={}, height={}" .format(w,h))
-                g.combined_image = np.concatenate((img1, bg2), axis = 0)
-                w,h = g.combined_image.shape[1], g.combined_image.shape[0]
-                #print("combined image size: width={}, height={}" .format(w,h))
-                g.tmax = h
-            else:
-                #print("using unmodified heatmap image")
-                g.combined_image = img1
-                g.tmax = h1
+    def poll(self):
+        
+        return None if (not self.at_end()) else 0
+        
+    def terminate(self):
+        
+        self.next = len(self.times)
 
-        #print("done")
+
+def start_replay(path, speed, procs=0):
+    
+    print("\nStarting replay of {} at {}x" .format(path, speed))
+    
+    times, rows, freqs = load_capture(path, procs)
+    if (len(times) == 0):
+        print("No sweeps found")
+        sys.exit(1)
+    
+    # not <name>_replay, which is the full render of the capture
+    g.filename = os.path.splitext(path)[0] + "_playback"
+    g.fig_title = ("RTL_SpectrumSweeper replay of '{}' at {}x" .format(path, speed))
+    
+    # the layout is already known, so every replayed hop is a whole sweep
+    g.assembler = sweep_assembler()
+    g.assembler.set_layout(freqs)
+    
+    g.watcher = sweep_watcher(0)
+    g.reader = replay_source(times, rows, freqs, speed, g.watcher)
+    g.rtl_proc = g.reader
+    g.watcher.notify()
+
+
+"""############################################################################
+
+    function:   browse_capture 
+
+    Opens the whole sweep history of a store (a csv capture is converted 
+    first) in a waterfall window. The y axis is the sweep number from the
+    start of the capture, and the x axis the bin. On every zoom or pan, the
+    view is fetched from the pyramid level that matches it, so a week of 
+    sweeps is as quick to look at as the last minute. The colors are 
+    scaled to the dB range of the view. If the capture is still running 
+    (with --store), new sweeps are followed while the view shows the end. 
+
+############################################################################"""
+
+browse_idle_s = 5.0     # a store this long untouched is not being captured
+
+def browse_capture(path):
+    
+    base = path[:-len(".sweeps")] if path.endswith(".sweeps") else os.path.splitext(path)[0]
+    if (not os.path.isfile(base + ".sweeps")):
+        if (not path.endswith(".csv")):
+            print("No sweep store found for {}" .format(path))
+            return
+        convert_csv_to_store(path, base, g.offset)
+    
+    store = sweep_store(base).open()
+    g.pyramid = waterfall_pyramid(store)
+    # a running capture keeps its own pyramid up to date, so only build 
+    # the missing levels of a store that is no longer being written
+    if ((time.time() - os.path.getmtime(store.data_path)) > browse_idle_s):
+        start = time.time()
+        added = g.pyramid.update()
+        g.pyramid.close()
+        if (added > 0):
+            print("Built {} pyramid rows in {:0.1f} s" .format(added, time.time() - start))
+    
+    g.browse_count = store.count()
+    bins = store.header["bins"]
+    print("Browsing {} sweeps x {} bins ({} levels)" .format(g.browse_count, bins, 
+        g.pyramid.top() + 1))
+    
+    g.palette = build_palette(g.palette_name, g.rgbxy)
+    g.fig = plt.figure("RTL_SpectrumSweeper browse of '{}'" .format(path))
+    g.ax2 = g.fig.add_subplot(1, 1, 1)
+    g.ax2.set_facecolor('#000000')
+    g.ax2.set_xlabel("FFT Bins (N)")
+    g.ax2.set_ylabel("Spectrum Sweeps (N)")
+    g.wf_image = g.ax2.imshow(np.zeros((1, 1, 3), dtype=np.uint8), 
+        extent=(-0.5, bins-0.5, g.browse_count-0.5, -0.5), interpolation='nearest')
+    g.ax2.set_aspect('auto')
+    g.ax2.set_xlim(-0.5, bins-0.5)
+    g.ax2.set_ylim(max(g.browse_count, 1)-0.5, -0.5)
+    plt.tight_layout()
+    
+    browse_refresh()
+    g.ax2.callbacks.connect('xlim_changed', on_browse_view)
+    g.ax2.callbacks.connect('ylim_changed', on_browse_view)
+    g.fig.canvas.mpl_connect('resize_event', on_browse_view)
+    
+    # zoom and pan only mark the view, and the timer fetches it once both
+    # axis limits have been set
+    g.anim = g.fig.canvas.new_timer(interval=g.anim_intvl)
+    g.anim.add_callback(browse_poll)
+    g.anim.start()
+    plt.show()
+    g.pyramid.close()
+
+
+def on_browse_view(*args):
+    
+    g.browse_dirty = True
+
+
+def browse_poll():
+    
+    try:
+        
+        count = g.pyramid.store.count()
+        if (count != g.browse_count):
+            lo, hi = g.ax2.get_ylim()
+            if (max(lo, hi) >= (g.browse_count - 1)):
+                # the view shows the end, so follow the new sweeps
+                g.ax2.set_ylim(count-0.5, min(lo, hi))
+            g.browse_count = count
+            g.browse_dirty = True
+        
+        if (g.browse_dirty):
+            browse_refresh()
+            g.fig.canvas.draw_idle()
         
     except Exception as e:
         
-        print("\nException occurred in update_waterfall")
+        print("\nException occurred in browse_poll")
         print(e)
+
+
+def browse_refresh():
     
+    g.browse_dirty = False
+    p = g.pyramid
+    
+    # the view in store rows and bins
+    lo, hi = g.ax2.get_xlim()
+    b0 = max(int(np.floor(min(lo, hi) + 0.5)), 0)
+    b1 = min(int(np.ceil(max(lo, hi) + 0.5)), p.bins[0])
+    lo, hi = g.ax2.get_ylim()
+    r0 = max(int(np.floor(min(lo, hi) + 0.5)), 0)
+    r1 = min(int(np.ceil(max(lo, hi) + 0.5)), g.browse_count)
+    if ((r1 <= r0) or (b1 <= b0)):
+        return
+    
+    bbox = g.ax2.get_window_extent()
+    px_w, px_h = max(int(bbox.width), 1), max(int(bbox.height), 1)
+    k = p.level_for(r0, r1, b0, b1, px_w * px_h)
+    
+    # the same view in level k rows and bins
+    fs = p.fshift[k]
+    lr0, lr1 = r0 >> k, -(-r1 >> k)
+    lb0, lb1 = b0 >> fs, -(-b1 >> fs)
+    db = p.fetch(k, lr0, lr1, lb0, lb1)
+    
+    dec = bin_decimator(db.shape[1])
+    dec.plan(0, db.shape[1], px_w)
+    db = dec.peak(db)
+    if (np.all(np.isnan(db))):
+        return
+    db_min, db_max = float(np.nanmin(db)), float(np.nanmax(db))
+    
+    g.wf_image.set_data(colorize(db, g.palette, db_min, db_max))
+    g.wf_image.set_extent(((lb0 << fs)-0.5, (lb1 << fs)-0.5, (lr1 << k)-0.5, (lr0 << k)-0.5))
+    
+    times = p.store.times()
+    g.ax2.set_title("level {} ({} sweeps x {} bins per value), {} to {}" .format(k, 
+        1 << k, 1 << fs, datetime.datetime.fromtimestamp(times[r0]).strftime("%Y-%m-%d %H:%M:%S"),
+        datetime.datetime.fromtimestamp(times[r1-1]).strftime("%Y-%m-%d %H:%M:%S")), fontsize='small')
+
 
 """############################################################################
 
-    function:   update_spectrum 
+    function:   run_headless 
+
+    Runs the capture without a gui. This thread waits on the pipeline's 
+    ready event instead of a gui timer, and animation_poll does the same 
+    work as in the gui, except that the images are written to files (every
+    --save N sweeps, and when the capture ends) instead of being drawn. 
 
 ############################################################################"""
 
-def update_spectrum():
+class headless_timer:
     
-    print("Updating spectrum")
+    def __init__(self, interval):
+        
+        self.interval = interval
+        self.running = True
+        
+    def stop(self):
+        
+        self.running = False
+
+
+def run_headless():
+    
+    print("\nRunning headless... ", end='', flush=True)
+    
+    g.anim = headless_timer(g.watcher.interval_ms())
+    while (g.anim.running):
+        g.pipeline.ready.wait(g.anim.interval / 1000.0)
+        animation_poll(0)
+    print("done")
+
+
+"""############################################################################
+
+    function:   run_batch / run_capture 
+
+    Runs every capture listed in a batch file, one per line with the same
+    options as the command line (blank lines and # comments are skipped). 
+    The captures run headless in a process pool, one capture per process 
+    and by default one process per cpu core. Each capture needs its own 
+    dongle (e.g. '-d 1' in its rtl_power options), or its own --rtl_power.
+    
+    The lines run at the same time, in no particular order, so a line must
+    not depend on another (e.g. --replay of a capture made by the same 
+    batch); run those from a second batch. A --replay line parses its csv 
+    file in its own process, since a pool process cannot start a pool, 
+    and a line cannot run another --batch. Returns the number of lines 
+    that failed (an exception, or a non-zero exit). 
+
+############################################################################"""
+
+def run_batch(path, procs=0):
+    
+    captures = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if (line != ""):
+                captures.append(shlex.split(line))
+    
+    if (procs <= 0):
+        procs = multiprocessing.cpu_count()
+    procs = min(procs, max(len(captures), 1))
+    print("\nRunning {} captures in {} processes" .format(len(captures), procs))
+    
+    with multiprocessing.Pool(processes=procs) as pool:
+        results = pool.map(run_capture, captures)
+    
+    failed = 0
+    for args, (ok, result) in zip(captures, results):
+        print("{}: {}" .format(" ".join(args), result))
+        if (not ok):
+            failed += 1
+    if (failed > 0):
+        print("{} of {} captures failed" .format(failed, len(captures)))
+    return failed
+
+
+def run_capture(args):
+    
+    # each pool process runs one capture at a time with its own state. 
+    # Returns (ok, result). 
+    global g
+    g = global_vars()
+    g.batch_worker = True
+    sys.argv = ["RTL_SpectrumSweeper.py", "--headless"] + list(args)
     
     try:
-        
-        cmd_str = ("python flatten.py {}.csv" .format(g.filename)) 
-        cmd = cmd_str.split()
-        #print(cmd)
+        main()
+        if (g.failed):
+            return (False, "failed after {} sweeps" .format(g.sweep_count))
+        return (True, "{} sweeps" .format(g.sweep_count))
+    except SystemExit as e:
+        return ((e.code in (None, 0)), "exited ({})" .format(e.code))
+
+
+"""############################################################################
+
+    class:      scan_band / function: run_plan 
+
+    Shares one dongle between several bands (--plan). The plan file lists 
+    one band per line, with the same options as the command line (blank 
+    lines and # comments are skipped): its own rtl_power -f/-i/-g, its own
+    filename, and any of the options of a capture (--palette, --store, 
+    --detect, -s, ...), plus '--dwell' for how long each visit lasts. A 
+    --dwell given next to --plan is the dwell of the bands without one. 
+    
+    The bands are visited in turn, for as many rounds as it takes for all 
+    of them to stop (-s), or until Ctrl-C. Each band keeps its own state 
+    (a global_vars, which is swapped into g for its visit), so its 
+    waterfall, spectrum, color scale, csv file, store and detector carry on
+    from one visit to the next, and only rtl_power is restarted. rtl_power 
+    is run with '-e <dwell>' (in whole seconds), so it ends each visit 
+    cleanly after a whole sweep. The plan runs headless. Each band's 
+    images are written every --save N sweeps, when it stops, and when the 
+    plan ends (not after every visit, which would add to the switching 
+    time). 
+    
+    After each round, the revisit time (from the start of one visit of a 
+    band to the start of the next) and the duty cycle (the share of the 
+    time that the band was being swept) of each band are printed, with the
+    rtl_power startup time per visit, so the dwells can be tuned for 
+    coverage. 
+
+############################################################################"""
 
-        proc = subprocess.Popen(cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT, 
-            universal_newlines=True)
+class scan_band:
+    
+    def __init__(self, args, dwell_s):
         
-        g.x_vals = []; g.y_vals = []; 
+        self.args = args
+        self.dwell_s = dwell_s      # unless the band has its own --dwell
+        self.state = None           # the global_vars of this band
+        self.done = False
+        self.visits = 0
+        self.sweeps = 0
+        self.last_start = None
+        self.revisit_s = 0.0        # sum of the times between visits
+        self.startup_s = 0.0        # from starting rtl_power to its data
+        self.swept_s = 0.0          # from its first data to its exit
         
-        while(True):
-            rspn = (str(proc.stdout.readline())).rstrip()
-            if (rspn == ""):
-                #print("done")
-                break
+    def visit(self):
+        
+        global g
+        start = time.monotonic()
+        
+        try:
+            
+            if (self.state is None):
+                g = global_vars()
+                g.dwell_s = self.dwell_s
+                argv = sys.argv
+                try:
+                    sys.argv = ["RTL_SpectrumSweeper.py", "--headless"] + list(self.args)
+                    process_args()
+                finally:
+                    sys.argv = argv
+                g.plan_band = True
+                self.state = g
+                count = 0
+                if (len(g.devices) > 1):
+                    print("A plan band uses one dongle, so --devices is not supported")
+                    self.done = True
+                    return
+                # rtl_power ends each visit by itself, after a whole sweep
+                g.rtl_str = (g.rtl_cmd + " -e {:d}s" .format(int(round(g.dwell_s))) + 
+                    g.rtl_str[len(g.rtl_cmd):])
+                if (g.serve_port > 0):
+                    start_live_server()
+                start_rtl_power_process()
+                load_plotting('Agg')
+                wait_for_initial_data()
+                initialize_plot()
             else:
-                g.x_vals.append(float((rspn).split(",")[0]))
-                g.y_vals.append(float((rspn).split(",")[1]))
-                g.x_vals[-1] += g.offset
-                g.x_vals[-1] /= 1000000.0
-                #print(g.x_vals[-1], g.y_vals[-1])
-
-        #print("size of y_vals[] = {}" .format(len(g.y_vals)))
+                g = self.state
+                count = g.sweep_count
+                # the same band again, so the assembler keeps its layout 
+                # and the csv_sink, watcher and store stay open
+                g.assembler.discard()
+                g.rtl_proc = rtl_supervisor(g.rtl_str.split(), g.sink, g.watcher, 
+                    g.sweeptime, g.stall_k, g.restarts)
+                g.reader = g.rtl_proc
+                g.supervisors = [g.rtl_proc]
+                # the time between visits is not part of the sweep period
+                g.watcher.last_time = None
+            
+            g.done = False
+            g.drawn_seq = 0
+            g.pipeline = sweep_pipeline()
+            run_headless()
+            g.pipeline.stop()
+            g.rtl_proc.terminate()
+            
+            self.sweeps += g.sweep_count - count
+            sup = g.rtl_proc
+            if (sup.first_data is not None):
+                self.startup_s += sup.first_data - start
+                self.swept_s += (sup.ended or time.monotonic()) - sup.first_data
+            if (g.done):
+                self.done = True
+            
+        except SystemExit:
+            
+            # rtl_power could not be started for this band
+            self.done = True
         
-    except Exception as e:
+        finally:
+            
+            if (self.last_start is not None):
+                self.revisit_s += start - self.last_start
+            self.last_start = start
+            self.visits += 1
+            
+    def report(self, elapsed):
         
-        print("\nException occurred in update_spectrum")
-        print(e)
+        name = self.state.filename if (self.state is not None) else " ".join(self.args)
+        revisit = ("{:0.1f} s" .format(self.revisit_s / (self.visits - 1)) 
+            if (self.visits > 1) else "-")
+        print("{}: {} visits, {} sweeps, revisit {}, duty cycle {:0.1f}%, {:0.1f} s startup per visit{}" 
+            .format(name, self.visits, self.sweeps, revisit, 
+            100.0 * self.swept_s / max(elapsed, 1e-9), 
+            self.startup_s / max(self.visits, 1), 
+            " (stopped)" if self.done else ""))
+
 
+def run_plan(path):
+    
+    global g
+    top = g
+    
+    bands = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if (line != ""):
+                bands.append(scan_band(shlex.split(line), top.dwell_s))
+    print("\nScanning {} bands from {}" .format(len(bands), path))
+    
+    start = time.monotonic()
+    rounds = 0
+    try:
+        while (not all([b.done for b in bands])):
+            for b in bands:
+                if (not b.done):
+                    b.visit()
+            rounds += 1
+            elapsed = time.monotonic() - start
+            print("\nScan plan round {} ({:0.0f} s):" .format(rounds, elapsed))
+            for b in bands:
+                b.report(elapsed)
+            swept = sum([b.swept_s for b in bands])
+            print("Sweeping {:0.1f}% of the time, the rest is rtl_power startup and switching" 
+                .format(100.0 * swept / max(elapsed, 1e-9)))
+    except KeyboardInterrupt:
+        print("\nScan plan stopped")
     finally:
-        
-        proc.terminate()
-        
+        for b in bands:
+            if (b.state is not None):
+                g = b.state
+                finish_capture()
+        g = top
+
+
+"""############################################################################
+
+    function:   finish_capture 
+
+    Stops rtl_power and the threads of a capture, closes its files, and 
+    writes the last checkpoint and images. 
+
+############################################################################"""
+
+def finish_capture():
+    
+    if (g.pipeline is not None):
+        g.pipeline.stop()
+        if (g.pipeline.coalesced > 0):
+            print("The gui fell behind {} times (sweeps were batched)" .format(g.pipeline.coalesced))
+    save_checkpoint()
+    try:
+        g.rtl_proc.terminate()
+    except:
+        pass
+    if (g.sink is not None):
+        g.sink.close()
+    if (g.store is not None):
+        g.store.close()
+    if (g.pyramid is not None):
+        g.pyramid.close()
+    if (g.detector is not None):
+        g.detector.close()
+    if (g.server is not None):
+        g.server.stop()
+    if (g.shm is not None):
+        g.shm.close()
+    if ((g.wf is not None) and (g.last_save != g.sweep_count)):
+        save_outputs()
+
 
 """############################################################################
 
@@ -773,11 +4879,62 @@ def main():
     try:
     
         process_args()
-        start_rtl_power_process()
+        
+        if (g.batch_worker):
+            # a pool process cannot start a pool of its own
+            if (g.batch_file != ""):
+                print("A batch line cannot run another --batch")
+                sys.exit(2)
+            g.procs = 1
+        
+        if (g.batch_file != ""):
+            if (run_batch(g.batch_file, g.procs) > 0):
+                sys.exit(1)
+            return
+        
+        if (g.plan_file != ""):
+            run_plan(g.plan_file)
+            return
+        
+        if (g.convert_file != ""):
+            base = os.path.splitext(g.convert_file)[0]
+            convert_csv_to_store(g.convert_file, base, g.offset)
+            return
+        
+        if (g.replay_file != "") and (g.replay_speed <= 0):
+            load_image()
+            render_replay(g.replay_file, g.procs)
+            return
+        
+        if (g.browse_file != ""):
+            load_plotting()
+            browse_capture(g.browse_file)
+            return
+        
+        if (g.serve_port > 0):
+            start_live_server()
+        
+        if (g.replay_file != ""):
+            start_replay(g.replay_file, g.replay_speed, g.procs)
+        else:
+            start_rtl_power_process()
+        # rtl_power is busy with the first sweep while matplotlib loads
+        load_plotting('Agg' if g.headless else None)
         wait_for_initial_data()
         initialize_plot()
-        g.anim = animation.FuncAnimation(g.fig, animation_poll, interval=g.anim_intvl)
-        plt.tight_layout()
+        g.pipeline = sweep_pipeline()
+        
+        if (g.headless):
+            run_headless()
+            return
+        
+        # a plain timer is used rather than FuncAnimation, because 
+        # FuncAnimation requests a full redraw after every frame, which 
+        # would defeat the blitting done in update_plot. 
+        g.anim_intvl = g.watcher.interval_ms()
+        g.anim = g.fig.canvas.new_timer(interval=g.anim_intvl)
+        g.anim.add_callback(animation_poll, 0)
+        g.anim.start()
         
         print("\nRunning... ", end='', flush=True)
         plt.show() 
@@ -787,14 +4944,12 @@ def main():
         
         print("\nException occurred in main")
         print(e)
+        g.failed = True
     
     finally:
         
         print("\nrtl_scan Finished!")
-        try:
-            g.rtl_proc.terminate()
-        except:
-            pass
+        finish_capture()
 
 
 """############################################################################
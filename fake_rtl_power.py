@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+/* ######################################################################### */
+/*
+    fake_rtl_power.py
+
+    A stand-in for rtl_power that produces synthetic csv rows, so that
+    RTL_SpectrumSweeper can be run and tested without an rtl-sdr dongle.
+
+    It accepts the rtl_power options that RTL_SpectrumSweeper passes along
+    (-f, -i, -e, -1, -d, and the filename), and ignores the rest. Rows are
+    written to the file, or to stdout when the filename is '-' or omitted,
+    in the same format and hop layout that rtl_power uses. Each sweep has
+    a noise floor, a few steady carriers, and one carrier that keys on and
+    off, which is useful for exercising the activity detector.
+
+    To exercise the rtl_power supervisor, '--crash N' exits with code 1 
+    partway through sweep N (leaving a partly written line), and 
+    '--hang N' stops writing after N sweeps but keeps running. 
+
+    Example:
+
+        python RTL_SpectrumSweeper.py --pipe --rtl_power "python fake_rtl_power.py"
+            -i 1s -f 88M:108M:10k test.csv
+
+    Copyright 2018 David Hunt (www.DavesMotleyProjects.com)
+
+    Permission is hereby granted, free of charge, to any person obtaining a
+    copy of this software and associated documentation files (the "Software"),
+    to deal in the Software without restriction, including without limitation
+    the rights to use, copy, modify, merge, publish, distribute, sublicense,
+    and/or sell copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included
+    in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+    OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+    MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+    IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+    CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+    TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+    SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+ *                                                                           */
+/* ######################################################################### */
+"""
+
+import sys
+import time
+import math
+import random
+import datetime
+
+
+# rtl_power retunes in hops of at most this bandwidth
+max_hop_hz = 2000000
+
+
+"""############################################################################
+
+    function:   parse_freq / parse_duration
+
+    Parse rtl_power style values, e.g. '88M', '132000k', '10k', '3s', '1h'.
+
+############################################################################"""
+
+def parse_freq(s):
+
+    scale = {'k': 1e3, 'M': 1e6, 'G': 1e9}
+    if (s[-1] in scale):
+        return float(s[:-1]) * scale[s[-1]]
+    return float(s)
+
+
+def parse_duration(s):
+
+    scale = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if (s[-1].lower() in scale):
+        return float(s[:-1]) * scale[s[-1].lower()]
+    return float(s)
+
+
+"""############################################################################
+
+    function:   process_args
+
+############################################################################"""
+
+def process_args(argv):
+
+    opts = {
+        "lo": 88e6, "hi": 108e6, "step": 10e3,
+        "interval": 1.0, "exit_timer": 0.0, "single": False,
+        "device": 0, "filename": "-",
+        "crash": 0, "hang": 0,
+    }
+
+    skip = 0
+    for i in range(1, len(argv)):
+        arg = argv[i]
+        if (skip):
+            skip -= 1
+        elif (arg == "-f"):
+            lo, hi, step = argv[i+1].split(":")
+            opts["lo"], opts["hi"], opts["step"] = parse_freq(lo), parse_freq(hi), parse_freq(step)
+            skip = 1
+        elif (arg == "-i"):
+            opts["interval"] = parse_duration(argv[i+1])
+            skip = 1
+        elif (arg == "-e"):
+            opts["exit_timer"] = parse_duration(argv[i+1])
+            skip = 1
+        elif (arg == "-d"):
+            opts["device"] = int(argv[i+1])
+            skip = 1
+        elif (arg == "--crash"):
+            opts["crash"] = int(argv[i+1])
+            skip = 1
+        elif (arg == "--hang"):
+            opts["hang"] = int(argv[i+1])
+            skip = 1
+        elif (arg == "-1"):
+            opts["single"] = True
+        elif (arg in ["-g", "-c", "-w", "-p", "-t", "-F"]):
+            skip = 1
+        elif (arg.startswith("-") and (arg != "-")):
+            pass
+        else:
+            opts["filename"] = arg
+
+    return opts
+
+
+"""############################################################################
+
+    function:   hop_layout
+
+    Splits the range into equal hops no wider than max_hop_hz, like
+    rtl_power does, and returns a list of (hz_low, hz_high, hz_step, bins).
+
+############################################################################"""
+
+def hop_layout(lo, hi, step):
+
+    hops = max(int(math.ceil((hi - lo) / max_hop_hz)), 1)
+    hop_hz = (hi - lo) / hops
+    bins = max(int(math.ceil(hop_hz / step)), 1)
+    hz_step = hop_hz / bins
+
+    layout = []
+    for h in range(hops):
+        hz_low = lo + h * hop_hz
+        layout.append((int(hz_low), int(hz_low + hop_hz), hz_step, bins))
+    return layout
+
+
+"""############################################################################
+
+    function:   sweep_lines
+
+    Returns the csv lines of one synthetic sweep.
+
+############################################################################"""
+
+def sweep_lines(layout, sweep, now):
+
+    lo = layout[0][0]; hi = layout[-1][1]
+    carriers = [lo + (hi - lo) * f for f in (0.21, 0.5, 0.77)]
+    # this one is on for 5 sweeps out of every 12
+    if ((sweep % 12) < 5):
+        carriers.append(lo + (hi - lo) * 0.63)
+
+    date_str = now.strftime("%Y-%m-%d")
+    time_str = now.strftime("%H:%M:%S")
+
+    lines = []
+    for hz_low, hz_high, hz_step, bins in layout:
+        values = []
+        for b in range(bins):
+            f = hz_low + b * hz_step
+            db = -50.0 + random.gauss(0, 1.5)
+            for c in carriers:
+                if (abs(f - c) < 3 * hz_step):
+                    db = max(db, -15.0 + random.gauss(0, 1.0))
+            values.append("{:.2f}" .format(db))
+        lines.append("{}, {}, {}, {}, {:.2f}, {}, {}\n" .format(date_str, time_str,
+            hz_low, hz_high, hz_step, 16, ", ".join(values)))
+    return lines
+
+
+"""############################################################################
+
+    function:   main
+
+############################################################################"""
+
+def main():
+
+    opts = process_args(sys.argv)
+    layout = hop_layout(opts["lo"], opts["hi"], opts["step"])
+
+    sys.stderr.write("Found 1 device(s):\n  0:  Fake, RTL2838UHIDIR, SN: {:08d}\n\n" .format(opts["device"]))
+    sys.stderr.write("Using device {}: Fake rtl_power\n" .format(opts["device"]))
+    sys.stderr.write("[R82XX] PLL not locked!\n")
+    sys.stderr.flush()
+
+    if (opts["filename"] == "-"):
+        out = sys.stdout
+    else:
+        out = open(opts["filename"], "w")
+
+    start = time.time()
+    sweep = 0
+    try:
+        while (True):
+            sweep_start = time.time()
+            lines = sweep_lines(layout, sweep, datetime.datetime.now())
+            if ((opts["crash"] > 0) and (sweep >= opts["crash"])):
+                out.write(lines[0][:len(lines[0]) // 2])
+                out.flush()
+                sys.stderr.write("cb transfer status: 1, canceling...\n")
+                sys.exit(1)
+            if ((opts["hang"] > 0) and (sweep >= opts["hang"])):
+                while (True):
+                    time.sleep(1)
+            out.writelines(lines)
+            out.flush()
+            sweep += 1
+
+            if (opts["single"]):
+                break
+            if ((opts["exit_timer"] > 0) and ((time.time() - start) >= opts["exit_timer"])):
+                break
+
+            time.sleep(max(opts["interval"] - (time.time() - sweep_start), 0))
+
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+    finally:
+        if (out is not sys.stdout):
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+/* ######################################################################### */
+/*
+    shm_consumer.py
+
+    A reference reader for the shared memory sweeps that RTL_SpectrumSweeper
+    publishes with '--shm NAME', for other programs (classifiers, loggers)
+    that want the assembled sweeps without parsing the csv file again.
+
+    sweep_reader attaches to the block and maps it as numpy arrays, so a
+    sweep is read in place, without copying or parsing. The layout is
+    described in the sweep_shm class of RTL_SpectrumSweeper.py. Sweeps are
+    numbered from 1 by 'seq'. A reader has to keep up to within the number
+    of slots of the newest sweep, or the older ones are overwritten; row()
+    returns None for those, and a sweep that was used in place should be
+    checked with valid() afterwards.
+
+    Run on its own, it follows the sweeps and prints the peak of each one.
+    '--check' runs a self test instead: a synthetic producer (the sweep_shm
+    class of RTL_SpectrumSweeper.py, in another process) publishes known
+    sweeps, and the reader checks what it gets.
+
+    Example:
+
+        python RTL_SpectrumSweeper.py --shm rtlsweeps -i 1s -f 88M:108M:10k test.csv
+        python shm_consumer.py rtlsweeps
+
+    Requires Python 3.8 or later (multiprocessing.shared_memory).
+
+    Copyright 2018 David Hunt (www.DavesMotleyProjects.com)
+
+    Permission is hereby granted, free of charge, to any person obtaining a
+    copy of this software and associated documentation files (the "Software"),
+    to deal in the Software without restriction, including without limitation
+    the rights to use, copy, modify, merge, publish, distribute, sublicense,
+    and/or sell copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included
+    in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+    OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+    MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+    IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+    CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+    TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+    SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+ *                                                                           */
+/* ######################################################################### */
+"""
+
+import os
+import sys
+import time
+import struct
+import datetime
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+# the same layout as sweep_shm in RTL_SpectrumSweeper.py
+shm_magic = b"RTLSWEEP"
+shm_header = struct.Struct("<8sIIIIdddQ")
+shm_header_size = 64
+shm_seq_offset = 48
+
+
+"""############################################################################
+
+    function:   attach
+
+    Attaches to an existing block. Before Python 3.13 this also registers
+    the block with the resource tracker, which would remove it when this
+    program exits, so it is unregistered again.
+
+############################################################################"""
+
+def attach(name):
+
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name)
+        if (os.name == "posix"):
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+"""############################################################################
+
+    class:      sweep_reader
+
+############################################################################"""
+
+class sweep_reader:
+
+    def __init__(self, name):
+
+        self.shm = attach(name)
+        buf = self.shm.buf
+        (magic, version, bins, slots, flags, self.freq_start, self.freq_step,
+            self.offset, seq) = shm_header.unpack_from(buf, 0)
+        if ((magic != shm_magic) or (version != 1)):
+            self.shm.close()
+            raise ValueError("'{}' is not a sweep block" .format(name))
+        self.bins = bins
+        self.slots = slots
+
+        at = shm_header_size
+        self.freqs = np.ndarray((bins,), dtype=np.float64, buffer=buf, offset=at)
+        at += 8 * bins
+        self.slot_seq = np.ndarray((slots,), dtype=np.uint64, buffer=buf, offset=at)
+        at += 8 * slots
+        self.times = np.ndarray((slots,), dtype=np.float64, buffer=buf, offset=at)
+        at += 8 * slots
+        self.rows = np.ndarray((slots, bins), dtype=np.float32, buffer=buf, offset=at)
+        self.seq = np.ndarray((1,), dtype=np.uint64, buffer=buf, offset=shm_seq_offset)
+
+    def head(self):
+
+        # the newest sweep (0 = none yet)
+        return int(self.seq[0])
+
+    def valid(self, seq):
+
+        return ((seq > 0) and (int(self.slot_seq[(seq - 1) % self.slots]) == seq))
+
+    def row(self, seq):
+
+        # returns (timestamp, dB row) of sweep seq, the row in place, or
+        # None when it is not there (not yet written, or overwritten)
+        k = (seq - 1) % self.slots
+        if (not self.valid(seq)):
+            return None
+        timestamp = float(self.times[k])
+        if (not self.valid(seq)):
+            return None
+        return (timestamp, self.rows[k])
+
+    def close(self):
+
+        # the numpy views must be gone before the block can be closed
+        self.freqs = self.slot_seq = self.times = self.rows = self.seq = None
+        self.shm.close()
+
+
+"""############################################################################
+
+    function:   follow
+
+    Prints the peak of each new sweep, and how many were missed when this
+    reader fell behind.
+
+############################################################################"""
+
+def follow(name):
+
+    reader = sweep_reader(name)
+    mhz = (reader.freqs + reader.offset) / 1e6
+    print("{}: {} bins, {:0.6f} to {:0.6f} MHz, {} slots" .format(name, reader.bins,
+        mhz[0], mhz[-1], reader.slots))
+
+    seq = reader.head()
+    missed = 0
+    got = db_row = None
+    try:
+        while (True):
+            head = reader.head()
+            if (head < seq):
+                print("The capture was restarted")
+                seq = head
+            if ((head - seq) >= reader.slots):
+                missed += head - seq - reader.slots + 1
+                seq = head - reader.slots + 1
+            while (seq < head):
+                seq += 1
+                got = reader.row(seq)
+                if (got is None):
+                    missed += 1
+                    continue
+                timestamp, db_row = got
+                if (np.all(np.isnan(db_row))):
+                    continue
+                peak = int(np.nanargmax(db_row))
+                line = ("{} sweep {}: peak {:0.1f} dB at {:0.6f} MHz, mean {:0.1f} dB"
+                    .format(datetime.datetime.fromtimestamp(timestamp).strftime("%H:%M:%S"),
+                    seq, db_row[peak], mhz[peak], np.nanmean(db_row)))
+                # the row was used in place, so check that it was not
+                # overwritten meanwhile
+                if (not reader.valid(seq)):
+                    missed += 1
+                    continue
+                print(line + ((", {} missed" .format(missed)) if (missed > 0) else ""))
+            time.sleep(0.05)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        got = db_row = None
+        reader.close()
+
+
+"""############################################################################
+
+    function:   check / synthetic_producer
+
+    The self test. Sweep n of the synthetic producer has the value n in
+    every bin and the timestamp 1000 + n. The reader first follows the
+    producer, then stops reading for a while so that the ring wraps, and
+    checks that the overwritten sweeps are reported as missing rather than
+    read torn.
+
+############################################################################"""
+
+check_name = "rtl_shm_check_{}" .format(os.getpid())
+check_bins = 4096
+check_slots = 16
+check_sweeps = 200
+
+def synthetic_producer(name, started, go, pause):
+
+    import io
+    import contextlib
+    sys.argv = ["RTL_SpectrumSweeper.py"]
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    with contextlib.redirect_stdout(io.StringIO()):
+        import RTL_SpectrumSweeper as sweeper
+        freqs = 88e6 + np.arange(check_bins) * 5e3
+        shm = sweeper.sweep_shm(name, freqs, -125e6, check_slots)
+    started.set()
+    go.wait()
+    for n in range(1, check_sweeps + 1):
+        shm.publish([(1000.0 + n, np.full(check_bins, n, dtype=np.float32))])
+        if (n == check_sweeps // 2):
+            # the reader stops reading while the ring wraps
+            pause.set()
+        time.sleep(0.002)
+    # the reader is done when the block goes away
+    time.sleep(1.0)
+    shm.close()
+
+
+def check():
+
+    started, go, pause = multiprocessing.Event(), multiprocessing.Event(), multiprocessing.Event()
+    producer = multiprocessing.Process(target=synthetic_producer,
+        args=(check_name, started, go, pause))
+    producer.start()
+    errors = []
+    got = 0
+    missing = 0
+
+    try:
+        if (not started.wait(30.0)):
+            raise RuntimeError("The producer did not start")
+        reader = sweep_reader(check_name)
+        if ((reader.bins != check_bins) or (reader.slots != check_slots)):
+            errors.append("layout {} bins, {} slots" .format(reader.bins, reader.slots))
+        if ((reader.freqs[0] != 88e6) or (reader.freq_step != 5e3) or (reader.offset != -125e6)):
+            errors.append("frequency axis {} + {} Hz, offset {}" .format(reader.freqs[0],
+                reader.freq_step, reader.offset))
+        go.set()
+
+        seq = 0
+        deadline = time.time() + 30.0
+        while ((seq < check_sweeps) and (time.time() < deadline)):
+            if (pause.is_set() and (seq >= check_sweeps // 2)):
+                # fall behind until the producer has finished
+                while (reader.head() < check_sweeps):
+                    time.sleep(0.01)
+                pause.clear()
+            head = reader.head()
+            while (seq < head):
+                seq += 1
+                r = reader.row(seq)
+                if (r is None):
+                    missing += 1
+                    continue
+                timestamp, db_row = r
+                ok = ((timestamp == 1000.0 + seq) and np.all(db_row == seq))
+                if (not reader.valid(seq)):
+                    missing += 1
+                elif (not ok):
+                    errors.append("sweep {} read wrong" .format(seq))
+                else:
+                    got += 1
+            time.sleep(0.001)
+        r = db_row = None
+        reader.close()
+
+        if (got + missing != check_sweeps):
+            errors.append("{} sweeps read and {} missing, of {}" .format(got, missing,
+                check_sweeps))
+        if (missing < (check_sweeps // 2 - check_slots)):
+            errors.append("only {} overwritten sweeps were noticed" .format(missing))
+
+    except Exception as e:
+        errors.append(str(e))
+    finally:
+        go.set()
+        producer.join(30.0)
+
+    print("{} sweeps read in place, {} overwritten sweeps reported missing" .format(got, missing))
+    for e in errors:
+        print("FAILED: {}" .format(e))
+    if (len(errors) == 0):
+        print("check passed")
+    return (0 if (len(errors) == 0) else 1)
+
+
+"""############################################################################
+
+    function:   main
+
+############################################################################"""
+
+def main():
+
+    if ((len(sys.argv) > 1) and (sys.argv[1] == "--check")):
+        sys.exit(check())
+    if (len(sys.argv) != 2):
+        print("usage: python shm_consumer.py NAME    (the --shm NAME of the capture)")
+        print("       python shm_consumer.py --check")
+        sys.exit(2)
+    follow(sys.argv[1])
+
+
+if __name__ == '__main__':
+    main()